@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import tarfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO
+
+from helpmedownload.Checksum import StreamingDigests, default_algorithms, mismatched_hashes
+
+try:
+    # Locks the archive against the other processes (ShardedRunner workers), not available on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+Archive_Layouts: tuple[str, ...] = ('version', 'model')
+
+
+def archive_target(image_path: Path, layout: str = 'version') -> tuple[Path, str]:
+    """
+    Where the image goes, for an image path like save_dir/model_name/version_name/file_name
+    :param image_path:
+    :param layout: 'version' (save_dir/model_name/version_name.tar) or 'model' (save_dir/model_name.tar)
+    :return: (archive path, member name)
+    """
+    version_dir = image_path.parent
+    if layout == 'model':
+        model_dir = version_dir.parent
+        return model_dir.with_name(f'{model_dir.name}.tar'), f'{version_dir.name}/{image_path.name}'
+    return version_dir.with_name(f'{version_dir.name}.tar'), image_path.name
+
+
+class TarArchive:
+    """
+    Append-only tar archive, with an index next to it (<archive>.index.jsonl) that gives the offset of every member:
+    {"name": ..., "offset": header offset, "data_offset": ..., "size": ..., "mtime": ..., "sha256": ..., ...}
+    per line, the last line of a name wins.
+
+    A member is written (and followed by the end-of-archive blocks) before its index line, so the index never
+    points to bytes that were not written. On every append the archive is cut back to the end of the last indexed
+    member, which drops the end-of-archive blocks and whatever a crash left behind.
+    If the index is missing (or has no record) while the archive is not empty, it is read back from the archive first.
+    """
+    Block_Size: int = 512
+    Index_Suffix: str = '.index.jsonl'
+    # Enough to hold the last index line
+    Tail_Read_Size: int = 64 * 1024
+
+    def __init__(self, archive_path: Path) -> None:
+        self.archive_path: Path = archive_path
+        self.index_path: Path = archive_path.with_name(archive_path.name + self.Index_Suffix)
+        archive_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file: BinaryIO = archive_path.open('r+b' if archive_path.exists() else 'w+b')
+        self.index_file: BinaryIO = self.index_path.open('a+b')
+
+    @classmethod
+    def padded_size(cls, size: int) -> int:
+        return -(-size // cls.Block_Size) * cls.Block_Size
+
+    def indexed_end(self) -> int:
+        """
+        The end of the last indexed member. A torn last line (crash while writing it) is cut off.
+        :return:
+        """
+        index_size = self.index_file.seek(0, os.SEEK_END)
+        start = max(0, index_size - self.Tail_Read_Size)
+        self.index_file.seek(start)
+        tail = self.index_file.read()
+        if tail and not tail.endswith(b'\n'):
+            self.index_file.truncate(start + tail.rfind(b'\n') + 1)
+            tail = tail[:tail.rfind(b'\n') + 1]
+        for line in reversed(tail.splitlines()):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            end = record['data_offset'] + self.padded_size(record['size'])
+            if end > self.file.seek(0, os.SEEK_END):
+                # The archive lost bytes that were indexed (like a power loss before they reached the disk)
+                end = self.drop_unwritten_records()
+            if end:
+                return end
+            break
+
+        # Nothing is indexed but the archive has data (the index was deleted), never cut off the members
+        if self.file.seek(0, os.SEEK_END):
+            return self.reindex()
+        return 0
+
+    def reindex(self) -> int:
+        """
+        Write the index again from the archive
+        :return: The end of the last member
+        :raise tarfile.ReadError: The archive can't be read, nothing is appended to it then
+        """
+        records = self.index_records(self.file)
+        self.index_file.truncate(0)
+        self.index_file.write(b''.join(json.dumps(record).encode('utf-8') + b'\n' for record in records))
+        self.index_file.flush()
+        return max((record['data_offset'] + self.padded_size(record['size']) for record in records), default=0)
+
+    def drop_unwritten_records(self) -> int:
+        """
+        Rewrite the index without the records of the members that are not (completely) in the archive
+        :return: The end of the last member kept
+        """
+        archive_size = self.file.seek(0, os.SEEK_END)
+        self.index_file.seek(0)
+        kept_lines, end = [], 0
+        for line in self.index_file.read().splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            record_end = record['data_offset'] + self.padded_size(record['size'])
+            if record_end <= archive_size:
+                kept_lines.append(line + b'\n')
+                end = max(end, record_end)
+        self.index_file.truncate(0)
+        self.index_file.write(b''.join(kept_lines))
+        self.index_file.flush()
+        return end
+
+    def append(self, name: str, data_file: BinaryIO, digests: dict[str, str]) -> dict:
+        """
+        :param name: Member name, like file_name or version_name/file_name
+        :param data_file: Read from its current position to the end
+        :param digests: Recorded in the index, like StreamingDigests.hexdigests()
+        :return: The index record
+        """
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            offset = self.indexed_end()
+            self.file.truncate(offset)
+            self.file.seek(offset)
+
+            size = os.fstat(data_file.fileno()).st_size - data_file.tell()
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = size
+            tar_info.mtime = int(time.time())
+            tar_info.mode = 0o644
+            header = tar_info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+            self.file.write(header)
+            while data := data_file.read(1024 * 1024):
+                self.file.write(data)
+            self.file.write(bytes(self.padded_size(size) - size))
+            # End-of-archive blocks, so the archive can be read by tar at any time
+            self.file.write(bytes(2 * self.Block_Size))
+            self.file.flush()
+
+            record = {'name': name, 'offset': offset, 'data_offset': offset + len(header), 'size': size,
+                      'mtime': tar_info.mtime, **digests}
+            self.index_file.seek(0, os.SEEK_END)
+            self.index_file.write(json.dumps(record).encode('utf-8') + b'\n')
+            self.index_file.flush()
+            return record
+        finally:
+            if fcntl:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        self.file.close()
+        self.index_file.close()
+
+    @classmethod
+    def load_index(cls, archive_path: Path) -> dict[str, dict]:
+        """
+        :param archive_path:
+        :return: {member name: index record}
+        """
+        records: dict[str, dict] = {}
+        try:
+            with archive_path.with_name(archive_path.name + cls.Index_Suffix).open('r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    records[record['name']] = record
+        except OSError:
+            pass
+        return records
+
+    @classmethod
+    def read_member(cls, archive_path: Path, name: str) -> bytes:
+        """
+        Read one image through the index, without scanning the archive
+        :param archive_path:
+        :param name:
+        :return:
+        """
+        record = cls.load_index(archive_path)[name]
+        with archive_path.open('rb') as f:
+            f.seek(record['data_offset'])
+            return f.read(record['size'])
+
+    @classmethod
+    def verify(cls, archive_path: Path) -> tuple[int, list[tuple[Path, str]]]:
+        """
+        Hash the members again and compare them with the index
+        :param archive_path:
+        :return: (number of members checked, [(archive path/member name, problem)])
+        """
+        problems: list[tuple[Path, str]] = []
+        records = cls.load_index(archive_path)
+        if not archive_path.exists():
+            return len(records), [(archive_path, 'missing')]
+        with archive_path.open('rb') as f:
+            for name, record in records.items():
+                algorithms = tuple(algorithm for algorithm in default_algorithms() if algorithm in record)
+                digests = StreamingDigests(algorithms)
+                f.seek(record['data_offset'])
+                digests.update(f.read(record['size']))
+                if digests.size != record['size']:
+                    problems.append((archive_path / name, 'truncated'))
+                elif mismatched := mismatched_hashes(digests.hexdigests(), {a: record[a] for a in algorithms}):
+                    problems.append((archive_path / name, f'content changed ({", ".join(mismatched)})'))
+        return len(records), problems
+
+    @classmethod
+    def rebuild_index(cls, archive_path: Path) -> int:
+        """
+        Write the index again from the archive (when the index was lost), the members are hashed again
+        :param archive_path:
+        :return: The number of members
+        """
+        with archive_path.open('rb') as f:
+            records = cls.index_records(f)
+        archive_path.with_name(archive_path.name + cls.Index_Suffix).write_text(
+            ''.join(json.dumps(record) + '\n' for record in records), encoding='utf-8'
+        )
+        return len(records)
+
+    @classmethod
+    def index_records(cls, file: BinaryIO) -> list[dict]:
+        """
+        Scan the archive and hash its members again. A member torn by a crash (the last one) is left out.
+        :param file: The archive, opened for reading
+        :return: The index records, in the order of the archive
+        :raise tarfile.ReadError: Not even the first member can be read
+        """
+        archive_size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        records, member_count = [], 0
+        try:
+            # tarfile seeks to the next header itself, the data can be read in between
+            with tarfile.open(fileobj=file, mode='r:') as tar:
+                for member in tar:
+                    member_count += 1
+                    if member.offset_data + cls.padded_size(member.size) > archive_size:
+                        break
+                    if not member.isfile():
+                        continue
+                    digests = StreamingDigests()
+                    file.seek(member.offset_data)
+                    digests.update(file.read(member.size))
+                    records.append({'name': member.name, 'offset': member.offset,
+                                    'data_offset': member.offset_data, 'size': member.size,
+                                    'mtime': int(member.mtime), **digests.hexdigests()})
+        except tarfile.ReadError:
+            # The torn tail after the members that were read
+            if not member_count:
+                raise
+        return records
+
+
+class ArchiveWriter:
+    """
+    Writes the downloaded images into tar archives (see archive_target), from a single writer thread,
+    so the download threads never write the same archive at the same time.
+    At most Max_Open_Archives are kept open, the least recently used one is closed first.
+    """
+    Max_Open_Archives: int = 16
+
+    def __init__(self) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ArchiveWriter')
+        # Only used by the writer thread
+        self.archives: OrderedDict[Path, TarArchive] = OrderedDict()
+        self.lock = threading.Lock()
+        self.is_closed: bool = False
+
+    def add(self, image_path: Path, data_file: BinaryIO, digests: dict[str, str], layout: str = 'version') -> Future:
+        """
+        :param image_path: Where the image would be saved as a loose file
+        :param data_file: Must stay open until the future is done
+        :param digests:
+        :param layout: See archive_target
+        :return: A future of the index record, done once the image is in the archive
+        """
+        archive_path, name = archive_target(image_path, layout)
+        with self.lock:
+            if self.is_closed:
+                raise RuntimeError('The archive writer is closed')
+            return self.executor.submit(self.write, archive_path, name, data_file, digests)
+
+    def write(self, archive_path: Path, name: str, data_file: BinaryIO, digests: dict[str, str]) -> dict:
+        if (archive := self.archives.get(archive_path)) is None:
+            archive = self.archives[archive_path] = TarArchive(archive_path)
+            if len(self.archives) > self.Max_Open_Archives:
+                _, oldest_archive = self.archives.popitem(last=False)
+                oldest_archive.close()
+        else:
+            self.archives.move_to_end(archive_path)
+        return archive.append(name, data_file, digests)
+
+    def close_all(self) -> None:
+        while self.archives:
+            _, archive = self.archives.popitem()
+            archive.close()
+
+    def close(self) -> None:
+        """
+        Finish the pending writes and close the archives
+        :return:
+        """
+        with self.lock:
+            if self.is_closed:
+                return
+            self.is_closed = True
+        self.executor.submit(self.close_all)
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python -m helpmedownload.ArchiveOutput list|verify|reindex <archive.tar>
+    # python -m helpmedownload.ArchiveOutput extract <archive.tar> <member name> <output file>
+    command, path = sys.argv[1], Path(sys.argv[2])
+    match command:
+        case 'list':
+            for member_name, index_record in TarArchive.load_index(path).items():
+                print(f'{index_record["size"]:>10}  {member_name}')
+        case 'verify':
+            checked_count, found = TarArchive.verify(path)
+            print(f'{checked_count} member(s) checked, {len(found)} problem(s)')
+            for member_path, problem in found:
+                print(f'{member_path}: {problem}')
+        case 'reindex':
+            print(f'{TarArchive.rebuild_index(path)} member(s) indexed')
+        case 'extract':
+            Path(sys.argv[4]).write_bytes(TarArchive.read_member(path, sys.argv[3]))
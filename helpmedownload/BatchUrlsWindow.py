@@ -1,8 +1,69 @@
 import re
 
-from PySide6.QtCore import Signal, Qt
-from PySide6.QtWidgets import (QDialog, QVBoxLayout, QPushButton, QWidget, QTextBrowser,
-                               QHBoxLayout, QTextEdit, QSizePolicy, QMessageBox, QFileDialog, QSpacerItem, QLabel)
+from PySide6.QtCore import Signal, Qt, QObject, QRunnable, QThreadPool, QStringListModel, Slot
+from PySide6.QtWidgets import (QDialog, QVBoxLayout, QPushButton, QWidget, QListView, QProgressBar,
+                               QHBoxLayout, QPlainTextEdit, QSizePolicy, QMessageBox, QFileDialog, QSpacerItem, QLabel)
+
+from helpmedownload.ModelsQuery import parse_models_query_spec
+
+
+Civitai_Url_Pattern = re.compile(r'https://civitai\.com/models/\d+(\/[\w-]+)?(\?modelVersionId=\d+)?$')
+
+
+def normalize_url(line: str) -> str:
+    """
+    Normalize a pasted URL, so that the same model pasted in different forms is only downloaded once
+    (http -> https, www.civitai.com -> civitai.com, no #fragment, no trailing /)
+    :param line:
+    :return:
+    """
+    url = line.strip()
+    if parse_models_query_spec(url) is not None:
+        return url
+    url = url.split('#', 1)[0]
+    url = re.sub(r'^(?:https?://)?(?:www\.)?civitai\.com', 'https://civitai.com', url)
+    path, question, query = url.partition('?')
+    return path.rstrip('/') + question + query
+
+
+class UrlsValidationRunnerSignals(QObject):
+    """
+    Signals for UrlsValidationRunner class
+    """
+    Validation_Progress_Signal = Signal(int)
+    Validation_Complete_Signal = Signal(tuple)
+
+
+class UrlsValidationRunner(QRunnable):
+    """
+    Validate, normalize and dedup the lines of the editor in the background
+    """
+    Progress_Step: int = 2000
+
+    def __init__(self, text: str) -> None:
+        super().__init__()
+        self.text = text
+        self.signals = UrlsValidationRunnerSignals()
+
+    @Slot()
+    def run(self) -> None:
+        valid_urls: dict[str, None] = {}  # dict as an ordered set
+        invalid_lines: list[str] = []
+        duplicate_count = 0
+
+        for line_number, line in enumerate(self.text.splitlines(), start=1):
+            if line_number % self.Progress_Step == 0:
+                self.signals.Validation_Progress_Signal.emit(line_number)
+            if not (url := normalize_url(line)):
+                continue
+            if not Civitai_Url_Pattern.match(url) and parse_models_query_spec(url) is None:
+                invalid_lines.append(f'Line {line_number}: {line.strip()}')
+            elif url in valid_urls:
+                duplicate_count += 1
+            else:
+                valid_urls[url] = None
+
+        self.signals.Validation_Complete_Signal.emit((list(valid_urls), invalid_lines, duplicate_count))
 
 
 class LoadingBatchUrlsWindow(QDialog):
@@ -14,6 +75,8 @@ class LoadingBatchUrlsWindow(QDialog):
     def __init__(self, batch_url_list: list = None, parent=None):
         super().__init__(parent)
         self.batch_url_list = batch_url_list or []
+        # Set when the user closes the dialog, a validation still running is ignored then
+        self.is_cancelled: bool = False
         self.initUI()
 
     def initUI(self):
@@ -21,16 +84,25 @@ class LoadingBatchUrlsWindow(QDialog):
         self.setGeometry(100, 100, 600, 400)
 
         self.v_layout = QVBoxLayout(self)
-        self.urls_editor = QTextEdit(self)
-        for url in self.batch_url_list:
-            self.urls_editor.append(url)
+        self.urls_editor = QPlainTextEdit(self)
+        self.urls_editor.setPlainText('\n'.join(self.batch_url_list))
         self.v_layout.addWidget(self.urls_editor)
 
+        self.h_check_layout = QHBoxLayout()
         self.label = QLabel('Check message')
         self.label.setAlignment(Qt.AlignCenter)
-        self.v_layout.addWidget(self.label)
-
-        self.check_message = QTextBrowser()
+        self.validation_progress_bar = QProgressBar(self)
+        self.validation_progress_bar.setVisible(False)
+        self.h_check_layout.addWidget(self.label)
+        self.h_check_layout.addWidget(self.validation_progress_bar)
+        self.v_layout.addLayout(self.h_check_layout)
+
+        # Only the visible rows are rendered, even with tens of thousands of invalid lines
+        self.check_message_model = QStringListModel(self)
+        self.check_message = QListView()
+        self.check_message.setModel(self.check_message_model)
+        self.check_message.setUniformItemSizes(True)
+        self.check_message.setEditTriggers(QListView.NoEditTriggers)
         sizePolicy1 = QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Ignored)
         sizePolicy1.setHorizontalStretch(0)
         sizePolicy1.setVerticalStretch(0)
@@ -69,6 +141,9 @@ class LoadingBatchUrlsWindow(QDialog):
         self.h_button_layout.setStretch(3, 1)
         self.h_button_layout.setStretch(4, 2)
 
+        self.validation_pool = QThreadPool(self)
+        self.validation_pool.setMaxThreadCount(1)
+
         self.v_layout.addLayout(self.h_button_layout)
         self.v_layout.setStretch(0, 12)
         self.v_layout.setStretch(1, 1)
@@ -95,8 +170,10 @@ class LoadingBatchUrlsWindow(QDialog):
             result = QMessageBox.question(self, 'Confirmation', 'Are you sure you want to cancel?',
                                           QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
             if result == QMessageBox.Yes:
+                self.is_cancelled = True
                 self.done(0)
         else:
+            self.is_cancelled = True
             self.done(0)
 
     def click_load_button(self) -> None:
@@ -109,34 +186,55 @@ class LoadingBatchUrlsWindow(QDialog):
             return
 
         with open(file_path, 'r', encoding='utf-8') as f:
-            urls_list = [line.strip() for line in f]
+            text = f.read()
 
-        self.urls_editor.clear()
-        for url in urls_list:
-            self.urls_editor.append(url)
-        self.check_message.clear()
+        # One call, instead of appending line by line
+        self.urls_editor.setPlainText(text)
+        self.check_message_model.setStringList([])
 
     def click_confirm_button(self) -> None:
         """
-        Preliminary check if the URL matches the pattern.
+        Preliminary check if the URL matches the pattern (or is a creator / tag / query line).
         If it is a valid match, emit a signal to the main window to start executing the task.
         :return:
         """
-        url_list = self.urls_editor.toPlainText().strip().split()
+        text = self.urls_editor.toPlainText()
+        self.set_validating(True, line_count=self.urls_editor.blockCount())
 
-        # pattern = re.compile(r'https://civitai[.]com/models/\d{4,5}(?:/.*)?|(?:[?]modelVersionId=\d{4,5})')
-        pattern = re.compile(r'https://civitai\.com/models/\d+(\/[\w-]+)?(\?modelVersionId=\d+)?$')
-        match_error_url_list = [url for url in url_list if not pattern.match(url)]
+        validation_runner = UrlsValidationRunner(text)
+        validation_runner.signals.Validation_Progress_Signal.connect(self.validation_progress_bar.setValue)
+        validation_runner.signals.Validation_Complete_Signal.connect(self.handle_validation_complete_signal)
+        self.validation_pool.start(validation_runner)
+
+    def set_validating(self, validating: bool, line_count: int = 0) -> None:
+        """
+        Show the progress bar and lock the editor and buttons while validating
+        :param validating:
+        :param line_count:
+        :return:
+        """
+        self.validation_progress_bar.setMaximum(line_count)
+        self.validation_progress_bar.setValue(0)
+        self.validation_progress_bar.setVisible(validating)
+        self.urls_editor.setReadOnly(validating)
+        self.load_button.setEnabled(not validating)
+        self.confirm_button.setEnabled(not validating)
+
+    @Slot(tuple)
+    def handle_validation_complete_signal(self, validation_result: tuple[list, list, int]) -> None:
+        valid_urls, invalid_lines, duplicate_count = validation_result
+        if self.is_cancelled:
+            return
+        self.set_validating(False)
 
-        if not match_error_url_list:
-            self.Loading_Batch_Urls_Signal.emit(url_list)
+        if not invalid_lines:
+            self.Loading_Batch_Urls_Signal.emit(valid_urls)
             self.reject(call_from_confirm_button=True)
             return
 
-        self.check_message.clear()
-        self.check_message.append('The following URLs do not match the specified pattern:')
-        for error_url in match_error_url_list:
-            self.check_message.append(f'{error_url}')
+        self.label.setText(f'{len(invalid_lines)} line(s) do not match the specified pattern'
+                           + (f', {duplicate_count} duplicate(s) will be skipped' if duplicate_count else ''))
+        self.check_message_model.setStringList(invalid_lines)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+from PySide6.QtCore import QObject, Signal, QRunnable, Slot
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+def default_algorithms() -> tuple[str, ...]:
+    return ('sha256', 'blake3') if blake3 else ('sha256',)
+
+
+class StreamingDigests:
+    """
+    Digests updated chunk by chunk while the bytes are written to disk, so the file never has to be read again.
+    BLAKE3 requires the blake3 package (pip3 install blake3), it is skipped without it.
+    """
+    Chunk_Size: int = 1024 * 1024
+
+    def __init__(self, algorithms: tuple[str, ...] | None = None) -> None:
+        self.hashers: dict = {}
+        for algorithm in algorithms or default_algorithms():
+            if algorithm == 'blake3':
+                if blake3:
+                    self.hashers[algorithm] = blake3.blake3()
+            else:
+                self.hashers[algorithm] = hashlib.new(algorithm)
+        self.size: int = 0
+
+    def update(self, data: bytes) -> None:
+        self.size += len(data)
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def update_from_file(self, file_path: Path) -> None:
+        with file_path.open('rb') as f:
+            while data := f.read(self.Chunk_Size):
+                self.update(data)
+
+    def hexdigests(self) -> dict[str, str]:
+        """
+        :return: Like {'sha256': ..., 'autov2': ..., 'blake3': ...}, AutoV2 of civitai is the first 10 digits of SHA256
+        """
+        digests = {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+        if 'sha256' in digests:
+            digests['autov2'] = digests['sha256'][:10]
+        return digests
+
+
+def mismatched_hashes(digests: dict[str, str], expected_hashes: dict[str, str]) -> list[str]:
+    """
+    Compare the digests with the hashes of the Models API (like {'SHA256': ..., 'AutoV2': ..., 'CRC32': ...}),
+    the hashes that were not computed are skipped
+    :param digests: From StreamingDigests.hexdigests()
+    :param expected_hashes:
+    :return: The names of the hashes that do not match
+    """
+    return [name for name, value in expected_hashes.items()
+            if (digest := digests.get(name.lower())) and digest.lower() != str(value).lower()]
+
+
+class ChecksumIndex:
+    """
+    Digests of the downloaded files of one folder, stored in the folder as .checksums.jsonl
+    {"name": file_name, "size": ..., "mtime_ns": ..., "sha256": ..., ...} per line, the last line of a name wins.
+    Lines are only appended, so download threads (and the processes of ShardedRunner) can share the file.
+    """
+    File_Name: str = '.checksums.jsonl'
+    Append_Lock = threading.Lock()
+
+    @classmethod
+    def append(cls, file_path: Path, digests: dict[str, str]) -> None:
+        stat = file_path.stat()
+        line = json.dumps({'name': file_path.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, **digests})
+        with cls.Append_Lock, (file_path.parent / cls.File_Name).open('a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    @classmethod
+    def load(cls, dir_path: Path) -> dict[str, dict]:
+        records: dict[str, dict] = {}
+        try:
+            with (dir_path / cls.File_Name).open('r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line torn by a crash
+                        continue
+                    records[record['name']] = record
+        except OSError:
+            pass
+        return records
+
+    @classmethod
+    def verify(cls, dir_path: Path) -> tuple[int, list[tuple[Path, str]]]:
+        """
+        Check the files of the folder against the index. Only the files whose size or mtime changed are read again.
+        :param dir_path:
+        :return: (number of files checked, [(file path, problem)])
+        """
+        problems: list[tuple[Path, str]] = []
+        records = cls.load(dir_path)
+        for name, record in records.items():
+            file_path = dir_path / name
+            try:
+                stat = file_path.stat()
+            except OSError:
+                problems.append((file_path, 'missing'))
+                continue
+            if stat.st_size != record['size']:
+                problems.append((file_path, f'size changed ({record["size"]} -> {stat.st_size} bytes)'))
+            elif stat.st_mtime_ns != record['mtime_ns']:
+                algorithms = tuple(algorithm for algorithm in default_algorithms() if algorithm in record)
+                digests = StreamingDigests(algorithms)
+                digests.update_from_file(file_path)
+                if mismatched := mismatched_hashes(digests.hexdigests(), {a: record[a] for a in algorithms}):
+                    problems.append((file_path, f'content changed ({", ".join(mismatched)})'))
+                else:
+                    # Only touched, record the new mtime so the next verify does not read it again
+                    cls.append(file_path, {key: value for key, value in record.items()
+                                           if key not in ('name', 'size', 'mtime_ns')})
+        return len(records), problems
+
+
+class ChecksumVerifyRunnerSignals(QObject):
+    """
+    Signals for ChecksumVerifyRunner class
+    """
+    Verify_Complete_Signal = Signal(tuple)
+
+
+class ChecksumVerifyRunner(QRunnable):
+    """
+    Verify every folder under root_dir that has a checksum index (and every archive of the archive output mode),
+    emits (root_dir, file count, problems)
+    """
+    def __init__(self, root_dir: Path) -> None:
+        super().__init__()
+        self.root_dir: Path = root_dir
+        self.signals = ChecksumVerifyRunnerSignals()
+
+    @Slot()
+    def run(self) -> None:
+        file_count = 0
+        problems: list[tuple[Path, str]] = []
+        for index_path in self.root_dir.rglob(ChecksumIndex.File_Name):
+            checked_count, folder_problems = ChecksumIndex.verify(index_path.parent)
+            file_count += checked_count
+            problems.extend(folder_problems)
+        # The archives of the archive output mode carry the digests in their own index
+        from helpmedownload.ArchiveOutput import TarArchive
+        for index_path in self.root_dir.rglob(f'*.tar{TarArchive.Index_Suffix}'):
+            archive_path = index_path.with_name(index_path.name.removesuffix(TarArchive.Index_Suffix))
+            checked_count, archive_problems = TarArchive.verify(archive_path)
+            file_count += checked_count
+            problems.extend(archive_problems)
+        self.signals.Verify_Complete_Signal.emit((self.root_dir, file_count, problems))
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    root = Path(sys.argv[1]) if len(sys.argv) > 1 else Path('DownloadTemp')
+    start_time = time.perf_counter()
+    total_count, all_problems = 0, []
+    for index_file in root.rglob(ChecksumIndex.File_Name):
+        count, found = ChecksumIndex.verify(index_file.parent)
+        total_count += count
+        all_problems.extend(found)
+    print(f'{total_count} file(s) checked in {time.perf_counter() - start_time:.2f}s')
+    for path, problem in all_problems:
+        print(f'{path}: {problem}')
@@ -1,21 +1,39 @@
+from __future__ import annotations
+
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
+from functools import cached_property
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import httpx
-from PySide6.QtCore import QThreadPool, Qt, Slot
-from PySide6.QtGui import QTextCharFormat, QMouseEvent
-from PySide6.QtWidgets import QMainWindow, QFileDialog, QProgressBar, QHBoxLayout, QLabel, QMessageBox
+from PySide6.QtCore import QThreadPool, Qt, Slot, QTimer
+from PySide6.QtGui import QMouseEvent, QAction, QActionGroup
+from PySide6.QtWidgets import (QMainWindow, QFileDialog, QProgressBar, QHBoxLayout, QLabel, QMessageBox,
+                               QToolButton, QMenu)
 
-from helpmedownload.ParserAndDownload import CivitaiUrlParserRunner, CivitaiImageDownloadRunner, VersionInfoData
-from helpmedownload.ShowHistoryWindow import HistoryWindow
-from helpmedownload.BatchUrlsWindow import LoadingBatchUrlsWindow
+from helpmedownload.JobScheduler import JobScheduler, Priority
+from helpmedownload.SingleFlight import SingleFlight
+from helpmedownload.ImageVariant import ImageVariantPolicy
+from helpmedownload.LogView import LogView
 from helpmedownload.HelpMeDownlaod_UI import Ui_MainWindow
 
+# The network stack (httpx), the runners and the dialogs are imported when they are first used,
+# so the window is shown without waiting for them
+if TYPE_CHECKING:
+    import httpx
+    from helpmedownload.ParserAndDownload import VersionInfoData
+    from helpmedownload.JobJournal import JobJournal
+    from helpmedownload.WatchList import WatchList
+    from helpmedownload.PostProcessing import PostProcessor
+    from helpmedownload.ProxyPool import ProxyPool
+    from helpmedownload.ArchiveOutput import ArchiveWriter
+
 
 @dataclass(slots=True)
 class ProgressBarData:
     progress_layout: QHBoxLayout
+    progress_label_widget: QLabel
     progress_bar_widget: QProgressBar
     completed: int
     executed: int
@@ -23,27 +41,61 @@ class ProgressBarData:
 
 
 class MainWindow(QMainWindow):
+    Watch_Tick_Milliseconds: int = 60_000
+    Max_Watch_Polls_Per_Tick: int = 2
+    Max_Log_Lines: int = 5000
+    Max_Finished_Progress_Bars: int = 30
+
     def __init__(self) -> None:
         super(MainWindow, self).__init__()
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
+        self.setup_log_views()
 
         self.pool: QThreadPool = QThreadPool.globalInstance()
-        self.httpx_client: httpx.Client = httpx.Client()
+        self.scheduler: JobScheduler = JobScheduler(self.pool, parent=self)
+        self.api_single_flight: SingleFlight = SingleFlight()
 
         self.batch_mode: bool = False
         self.batch_url: list = []
         self.batch_failed_urls: list = []
+        # URLs of the running batch that have already been started (parsed or expanded)
+        self.started_batch_urls: set[str] = set()
+        self.job_journal_path: Path = Path(__file__).parent.parent / 'batch_journal.jsonl'
+        self.job_journal: JobJournal | None = None
 
+        # Created with the first version folder
         self.save_dir: Path = Path(__file__).parent.parent / 'DownloadTemp'
-        if not self.save_dir.exists():
-            self.save_dir.mkdir(parents=True)
         self.ui.folder_line_edit.setText(str(self.save_dir))
         self.version_hyperlink: dict[str, str] = {}
+        self.version_model_id: dict[str, str] = {}
+        self.scheduled_version_ids: set[str] = set()
+        # Versions downloading for Watch Mode, they are not part of the single URL / batch shown in the UI
+        self.watch_version_ids: set[str] = set()
+        self.image_variant_policy: ImageVariantPolicy = ImageVariantPolicy()
+        # '' saves loose files, 'version' / 'model' appends the images to a tar archive per version / model
+        self.archive_layout: str = ''
+        self.archive_writer: ArchiveWriter | None = None
         self.progress_bar_info: dict = {}
         self.download_failed_info: dict[str, list] = {}
+        # Finished versions, oldest first. In batch mode only the latest progress bars of them are kept.
+        self.finished_version_ids: deque[str] = deque()
 
         self.thread_count: int = 0
+        # URL parsers and models queries that have not finished
+        self.parsing_count: int = 0
+        # Optional pool of egress proxies, used instead of httpx_client when loaded
+        self.proxy_pool: ProxyPool | None = None
+
+        # Optional post-processing of the downloaded images (thumbnail, WebP, hash, ...)
+        self.post_process_config_path: Path = Path(__file__).parent.parent / 'post_process.json'
+        self.post_processor: PostProcessor | None = None
+        self.log_dir: Path = Path(__file__).parent.parent
+
+        # Watch mode, poll the followed models and download only the new versions and images
+        self.watch_list_path: Path = Path(__file__).parent.parent / 'watch_list.json'
+        self.watch_timer: QTimer = QTimer(self, interval=self.Watch_Tick_Milliseconds)
+        self.watch_timer.timeout.connect(self.poll_watched_models)
 
         # The history function is not used temporarily
         self.ui.actionShowHistory.setEnabled(False)
@@ -54,10 +106,316 @@ class MainWindow(QMainWindow):
             history=self.convert_failed_info_dict_to_list(self.download_failed_info),
             special=True
         ))
+        self.setup_option_menu()
         self.ui.folder_line_edit.mousePressEvent = self.select_storage_folder
         self.ui.batch_push_button.clicked.connect(self.click_batch_button)
         self.ui.go_push_button.clicked.connect(self.start)
 
+        # Ask after the window is shown
+        QTimer.singleShot(0, self.check_unfinished_batch)
+
+    @cached_property
+    def httpx_client(self) -> httpx.Client:
+        import httpx
+        return httpx.Client()
+
+    @property
+    def request_client(self) -> httpx.Client | ProxyPool:
+        return self.proxy_pool or self.httpx_client
+
+    @cached_property
+    def watch_list(self) -> WatchList:
+        from helpmedownload.WatchList import WatchList
+        return WatchList(self.watch_list_path)
+
+    def setup_log_views(self) -> None:
+        """
+        Replace the text browsers of the generated UI with the bounded log views
+        :return:
+        """
+        self.operation_log = LogView(max_lines=self.Max_Log_Lines, parent=self.ui.centralwidget)
+        self.result_log = LogView(max_lines=self.Max_Log_Lines, parent=self.ui.centralwidget)
+        self.operation_log.model.setObjectName('operation')
+        self.result_log.model.setObjectName('result')
+        for text_browser, log_view in ((self.ui.operation_text_browser, self.operation_log),
+                                       (self.ui.result_text_browser, self.result_log)):
+            self.ui.verticalLayout.replaceWidget(text_browser, log_view)
+            text_browser.deleteLater()
+
+    def toggle_log_file(self, enable: bool) -> None:
+        """
+        Mirror the operation and result logs to rotating files (operation.log, result.log)
+        :param enable:
+        :return:
+        """
+        for log_view in (self.operation_log, self.result_log):
+            if enable:
+                log_view.model.enable_file_mirror(self.log_dir / f'{log_view.model.objectName()}.log')
+            else:
+                log_view.model.disable_file_mirror()
+
+    def setup_option_menu(self) -> None:
+        """
+        Create the Option menu (actions that are not part of the generated UI)
+        :return:
+        """
+        self.option_menu = self.ui.menubar.addMenu('Option')
+
+        self.action_pause = QAction('Pause Downloading', self, checkable=True)
+        self.action_pause.toggled.connect(self.toggle_pause)
+        self.option_menu.addAction(self.action_pause)
+
+        variant_menu = self.option_menu.addMenu('Image Variant')
+        variant_group = QActionGroup(self)
+        for text, mode, max_width in (('As Provided', 'as_is', 0),
+                                      ('Original', 'original', 0),
+                                      ('Max Width 450 (Preview)', 'max_width', 450),
+                                      ('Max Width 1024', 'max_width', 1024)):
+            action = QAction(text, variant_group, checkable=True, checked=mode == 'as_is')
+            action.triggered.connect(lambda _, m=mode, w=max_width: self.set_image_variant(mode=m, max_width=w))
+            variant_menu.addAction(action)
+        variant_menu.addSeparator()
+        self.action_prefer_webp = QAction('Prefer WebP', self, checkable=True)
+        self.action_prefer_webp.toggled.connect(
+            lambda checked: self.set_image_variant(preferred_format='webp' if checked else '')
+        )
+        variant_menu.addAction(self.action_prefer_webp)
+
+        output_menu = self.option_menu.addMenu('Output')
+        output_group = QActionGroup(self)
+        for text, layout in (('Loose Files', ''), ('Tar Archive per Version', 'version'),
+                             ('Tar Archive per Model', 'model')):
+            action = QAction(text, output_group, checkable=True, checked=layout == '')
+            action.triggered.connect(lambda _, l=layout: self.set_archive_layout(l))
+            output_menu.addAction(action)
+
+        self.option_menu.addSeparator()
+        self.action_watch_mode = QAction('Watch Mode', self, checkable=True)
+        self.action_watch_mode.toggled.connect(self.toggle_watch_mode)
+        self.option_menu.addAction(self.action_watch_mode)
+        self.option_menu.addAction('Follow Current URL', self.follow_current_url)
+        self.option_menu.addAction('Unfollow Current URL', self.unfollow_current_url)
+        self.option_menu.addSeparator()
+
+        self.action_post_process = QAction('Post-process Images', self, checkable=True)
+        self.action_post_process.toggled.connect(self.toggle_post_process)
+        self.option_menu.addAction(self.action_post_process)
+
+        self.option_menu.addAction('Verify Downloads', self.verify_downloads)
+
+        self.action_log_file = QAction('Save Logs to File', self, checkable=True)
+        self.action_log_file.toggled.connect(self.toggle_log_file)
+        self.option_menu.addAction(self.action_log_file)
+
+        proxy_menu = self.option_menu.addMenu('Proxies')
+        proxy_menu.addAction('Load Proxy List...', self.load_proxy_list)
+        proxy_menu.addAction('Use Direct Connection', self.use_direct_connection)
+        proxy_menu.addSeparator()
+        proxy_menu.addAction('Check Proxies', self.check_proxies)
+        proxy_menu.addAction('Show Proxy Stats', self.show_proxy_stats)
+
+    def load_proxy_list(self) -> None:
+        """
+        Spread the requests over the proxies of a .txt file (one proxy URL per line)
+        :return:
+        """
+        if self.thread_count:
+            self.operation_log.warning('Proxies can be changed after the downloads are finished')
+            return
+        file_path, _ = QFileDialog.getOpenFileName(self, 'Select Proxy List', '', 'Text Files (*.txt)')
+        if not file_path:
+            return
+        from helpmedownload.ProxyPool import ProxyPool, load_proxy_list
+        try:
+            proxy_pool = ProxyPool(load_proxy_list(Path(file_path)))
+        except (OSError, ValueError, ImportError) as e:
+            # ImportError: SOCKS proxies without socksio
+            self.operation_log.error(f'{file_path} | Failed to load the proxies: {e}')
+            return
+        if self.proxy_pool:
+            self.proxy_pool.close()
+        self.proxy_pool = proxy_pool
+        self.operation_log.info(f'{file_path} | Using {len(proxy_pool.proxies)} proxies')
+
+    def use_direct_connection(self) -> None:
+        if not self.proxy_pool:
+            return
+        if self.thread_count:
+            self.operation_log.warning('Proxies can be changed after the downloads are finished')
+            return
+        self.proxy_pool.close()
+        self.proxy_pool = None
+        self.operation_log.info('Using the direct connection')
+
+    def check_proxies(self) -> None:
+        """
+        Request the API through every proxy (using QThreadPool), the proxies that fail are marked unhealthy
+        :return:
+        """
+        if not self.proxy_pool:
+            self.operation_log.warning('No proxy list is loaded')
+            return
+        from helpmedownload.ProxyPool import ProxyHealthCheckRunner
+        check_runner = ProxyHealthCheckRunner(self.proxy_pool)
+        check_runner.signals.Health_Check_Complete_Signal.connect(self.handle_proxy_check_complete_signal)
+        self.operation_log.info(f'Start to check {len(self.proxy_pool.proxies)} proxies ...')
+        self.pool.start(check_runner)
+
+    @Slot(tuple)
+    def handle_proxy_check_complete_signal(self, check_results: tuple[tuple[str, str], ...]) -> None:
+        for proxy, error in check_results:
+            if error:
+                self.result_log.error(f'{proxy} | {error}')
+            else:
+                self.result_log.info(f'{proxy} | OK')
+
+    def show_proxy_stats(self) -> None:
+        if not self.proxy_pool:
+            self.operation_log.warning('No proxy list is loaded')
+            return
+        for stats in self.proxy_pool.stats():
+            text = (f'{stats.proxy} | {stats.requests} requests ({stats.outstanding} running), {stats.errors} errors, '
+                    f'{stats.bytes_downloaded / 1024 / 1024:.1f} MB, {stats.average_seconds:.2f}s on average')
+            if stats.is_healthy:
+                self.result_log.info(text)
+            else:
+                self.result_log.warning(f'{text}, unhealthy ({stats.last_error})')
+
+    def toggle_post_process(self, enable: bool) -> None:
+        """
+        Enable/Disable the post-processing stage, the steps are loaded from post_process.json (if it exists)
+        :param enable:
+        :return:
+        """
+        if enable:
+            from helpmedownload.PostProcessing import PostProcessor, load_post_process_steps
+            self.post_processor = PostProcessor(load_post_process_steps(self.post_process_config_path), parent=self)
+            self.post_processor.PostProcess_Fail_Signal.connect(self.handle_post_process_fail_signal)
+        elif self.post_processor:
+            self.post_processor.shutdown()
+            self.post_processor = None
+
+    def set_archive_layout(self, layout: str) -> None:
+        """
+        Save the next images as loose files ('') or append them to a tar archive per 'version' / 'model'
+        :param layout:
+        :return:
+        """
+        self.archive_layout = layout
+        if layout and not self.archive_writer:
+            from helpmedownload.ArchiveOutput import ArchiveWriter
+            self.archive_writer = ArchiveWriter()
+        if layout and self.post_processor:
+            self.operation_log.warning('The images written into archives are not post-processed')
+
+    def set_image_variant(self, mode: str | None = None, max_width: int = 0, preferred_format: str | None = None) -> None:
+        """
+        Change the image variant policy, it applies to the images scheduled afterwards
+        :param mode:
+        :param max_width:
+        :param preferred_format:
+        :return:
+        """
+        if mode is not None:
+            self.image_variant_policy.mode = mode
+            self.image_variant_policy.max_width = max_width
+        if preferred_format is not None:
+            self.image_variant_policy.preferred_format = preferred_format
+
+    def follow_current_url(self) -> None:
+        """
+        Follow the model of the URL in url_line_edit (for Watch Mode)
+        :return:
+        """
+        from helpmedownload.WatchList import model_id_of
+        url = self.ui.url_line_edit.text().strip()
+        if not (model_id := model_id_of(url)):
+            QMessageBox.warning(self, 'Warning', 'Enter a model URL to follow')
+            return
+        self.watch_list.follow(model_id, f'https://civitai.com/models/{model_id}')
+        self.operation_log.info(
+            f'{url} | Followed. The next poll records the current versions, later polls download what is new'
+        )
+
+    def unfollow_current_url(self) -> None:
+        from helpmedownload.WatchList import model_id_of
+        url = self.ui.url_line_edit.text().strip()
+        if self.watch_list.unfollow(model_id_of(url)):
+            self.operation_log.info(f'{url} | Unfollowed')
+
+    def toggle_watch_mode(self, enable: bool) -> None:
+        if enable:
+            self.watch_timer.start()
+            self.poll_watched_models()
+        else:
+            self.watch_timer.stop()
+
+    def poll_watched_models(self) -> None:
+        """
+        Poll the followed models that are due, a few per tick, so the polls are spread out
+        :return:
+        """
+        from helpmedownload.WatchList import CivitaiWatchPollRunner
+        for watched in self.watch_list.due_models(limit=self.Max_Watch_Polls_Per_Tick):
+            self.watch_list.mark_polling(watched)
+            poll_runner = CivitaiWatchPollRunner(watched, self.request_client, self.api_single_flight)
+            poll_runner.signals.UrlParser_Preliminary_Signal.connect(self.handle_watch_poll_preliminary_signal)
+            poll_runner.signals.UrlParser_Warning_Signal.connect(self.handle_parser_warning_signal)
+            poll_runner.signals.UrlParser_Complete_Signal.connect(self.handle_watch_poll_completed_signal)
+            # Without model_id, so Cancel Model only removes the queued images
+            self.scheduler.submit(poll_runner, priority=Priority.Low)
+
+    @Slot(tuple)
+    def handle_watch_poll_preliminary_signal(self, message_info: tuple[str, str]) -> None:
+        message, url = message_info
+        self.operation_log.warning(f'{url} | Watch poll failed: {message}')
+
+    @Slot(tuple)
+    def handle_watch_poll_completed_signal(self, completed_message: tuple) -> None:
+        """
+        Download the versions and images that have not been seen
+        :param completed_message:
+        :return:
+        """
+        from helpmedownload.WatchList import model_id_of
+        model_name, version_info, url = completed_message
+        if not (delta := self.watch_list.take_delta(model_id_of(url), version_info)):
+            return
+        # A version still downloading (the single URL / batch, or an earlier poll) keeps its progress bar,
+        # its new images are given back and picked up by a later poll
+        for version_id in list(delta):
+            bar_data: ProgressBarData | None = self.progress_bar_info.get(version_id)
+            if bar_data and bar_data.executed < bar_data.quantity:
+                for image_url in delta.pop(version_id).image_urls:
+                    self.watch_list.release(version_id, image_url)
+        if not delta:
+            return
+
+        image_count = sum(len(version_info_data.image_urls) for version_info_data in delta.values())
+        self.operation_log.info(f'{url} | Watch: {image_count} new image(s) of "{model_name}"')
+        # Re-polled versions may have been downloaded in this session already (and are finished now)
+        self.scheduled_version_ids.difference_update(delta)
+        self.watch_version_ids.update(delta)
+        self.start_to_download(delta)
+
+    def toggle_pause(self, pause: bool) -> None:
+        """
+        Pause/Resume starting new requests, the running ones are finished normally
+        :param pause:
+        :return:
+        """
+        if pause:
+            self.scheduler.pause()
+            self.ui.statusbar.showMessage('Paused')
+        else:
+            self.scheduler.resume()
+            self.ui.statusbar.clearMessage()
+
+    @Slot(tuple)
+    def handle_post_process_fail_signal(self, fail_info: tuple[str, str]) -> None:
+        image_path, failed_steps = fail_info
+        self.operation_log.warning(f'{image_path} | Post-process failed: {failed_steps}')
+
     def trigger_show_action(self, history: list, special: bool = False) -> None:
         """
         Pop up a QDialog window for show history
@@ -65,6 +423,7 @@ class MainWindow(QMainWindow):
         :param special: special for display failed urls
         :return:
         """
+        from helpmedownload.ShowHistoryWindow import HistoryWindow
         history_window = HistoryWindow(history=history, special=special, parent=self)
         # Only after this QDialog is closed, the main window can be used again
         history_window.setWindowModality(Qt.ApplicationModal)
@@ -81,6 +440,30 @@ class MainWindow(QMainWindow):
                 self.ui.folder_line_edit.setText(folder_path)
                 self.save_dir = Path(folder_path)
 
+    def verify_downloads(self) -> None:
+        """
+        Check the downloaded files of a folder (and its sub-folders) against their checksum index
+        :return:
+        """
+        if not (folder_path := QFileDialog.getExistingDirectory(self, 'Select Folder to Verify', str(self.save_dir),
+                                                                options=QFileDialog.ShowDirsOnly)):
+            return
+        from helpmedownload.Checksum import ChecksumVerifyRunner
+        verify_runner = ChecksumVerifyRunner(Path(folder_path))
+        verify_runner.signals.Verify_Complete_Signal.connect(self.handle_verify_complete_signal)
+        self.operation_log.info(f'{folder_path} | Start to verify ...')
+        self.pool.start(verify_runner)
+
+    @Slot(tuple)
+    def handle_verify_complete_signal(self, verify_result: tuple[Path, int, list]) -> None:
+        root_dir, file_count, problems = verify_result
+        if not problems:
+            self.result_log.info(f'{root_dir} | {file_count} file(s) verified, no problem found')
+            return
+        self.result_log.error(f'{root_dir} | {file_count} file(s) verified, {len(problems)} problem(s) found')
+        for file_path, problem in problems:
+            self.result_log.error(f'{file_path} | {problem}')
+
     def click_batch_button(self) -> None:
         """
         Pop up a QDialog window for handling batch urls
@@ -89,6 +472,7 @@ class MainWindow(QMainWindow):
         if not self.save_dir:
             QMessageBox.warning(self, 'Warning', 'Set the storage folder first')
             return
+        from helpmedownload.BatchUrlsWindow import LoadingBatchUrlsWindow
         load_urls_window = LoadingBatchUrlsWindow(batch_url_list=self.batch_url, parent=self)
         load_urls_window.Loading_Batch_Urls_Signal.connect(self.handle_loading_batch_urls_signal)
         load_urls_window.setWindowModality(Qt.ApplicationModal)
@@ -96,15 +480,99 @@ class MainWindow(QMainWindow):
 
     @Slot(list)
     def handle_loading_batch_urls_signal(self, urls: list) -> None:
+        if self.batch_mode:
+            self.update_running_batch_urls(urls)
+            return
+
         if urls:
+            from helpmedownload.JobJournal import JobJournal
+            self.job_journal = JobJournal.create(self.job_journal_path, self.save_dir, urls)
             self.batch_url = urls
+            self.started_batch_urls.clear()
             self.batch_mode = True
             self.clear_progress_bar()
-            self.download_failed_info.clear()
             self.download_from_batch_url()
 
+    def update_running_batch_urls(self, urls: list) -> None:
+        """
+        Replace the URLs that are still waiting in the running batch (the dialog shows the remaining ones),
+        so URLs can be added to or removed from the batch without waiting for it to finish
+        :param urls:
+        :return:
+        """
+        # The dialog may have been opened before some of its URLs were started, they are not added again
+        urls = [url for url in urls if url not in self.started_batch_urls]
+        queued_urls, new_urls = set(self.batch_url), set(urls)
+        added_urls = [url for url in urls if url not in queued_urls]
+        removed_urls = [url for url in self.batch_url if url not in new_urls]
+        if self.job_journal:
+            if added_urls:
+                self.job_journal.record('batch', durable=True, save_dir=str(self.save_dir), urls=added_urls)
+            for url in removed_urls:
+                self.job_journal.record('url_cancelled', durable=True, url=url)
+
+        was_waiting = not self.batch_url
+        self.batch_url = urls
+        if added_urls:
+            self.operation_log.info(f'{len(added_urls)} URL(s) added to the running batch')
+        # Nothing else would pick up the new URLs if the batch was only waiting for the last downloads
+        if was_waiting and self.batch_url:
+            self.download_from_batch_url()
+
+    def check_unfinished_batch(self) -> None:
+        """
+        If the journal of an interrupted batch exists, offer to resume the remaining work
+        :return:
+        """
+        if not self.job_journal_path.exists():
+            return
+        from helpmedownload.JobJournal import JobJournal
+        state = JobJournal.replay(self.job_journal_path)
+        if state is None:
+            return
+        if state.is_complete or not (state.remaining_urls or state.remaining_version_info):
+            self.job_journal_path.unlink(missing_ok=True)
+            return
+
+        result = QMessageBox.question(
+            self, 'Resume',
+            f'An unfinished batch was found ({len(state.remaining_urls)} URL(s) to parse, '
+            f'{state.remaining_image_count} image(s) to download).\nDo you want to resume it?',
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes
+        )
+        if result == QMessageBox.Yes:
+            self.resume_batch(state)
+        else:
+            self.job_journal_path.unlink(missing_ok=True)
+
+    def resume_batch(self, state) -> None:
+        """
+        Continue the batch from the journal state, the parsed versions are downloaded directly (no parsing again)
+        :param state: JournalState
+        :return:
+        """
+        self.save_dir = Path(state.save_dir)
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+        self.ui.folder_line_edit.setText(str(self.save_dir))
+
+        from helpmedownload.JobJournal import JobJournal
+        self.job_journal = JobJournal.compact(self.job_journal_path, state)
+        self.batch_url = state.remaining_urls
+        self.started_batch_urls.clear()
+        self.batch_failed_urls = state.failed_urls[:]
+        self.batch_mode = True
+        self.clear_progress_bar()
+        self.download_failed_info = {version_id: urls[:] for version_id, urls in state.failed_images.items()}
+        self.enable_buttons_and_edit(enable=False)
+
+        version_info = state.remaining_version_info
+        self.operation_log.info(f'Resume the unfinished batch | {len(version_info)} version(s)')
+        if not self.start_to_download(version_info):
+            self.continue_batch()
+
     def download_from_batch_url(self) -> None:
         url = self.batch_url.pop(0)
+        self.started_batch_urls.add(url)
         self.start(url_from_batch=url)
 
     def start(self, url_from_batch: str = '') -> None:
@@ -120,45 +588,105 @@ class MainWindow(QMainWindow):
             self.enable_buttons_and_edit()
             return
 
+        from helpmedownload.ModelsQuery import parse_models_query_spec
+        from helpmedownload.ParserAndDownload import CivitaiUrlParserRunner
+
+        # A creator / tag / query is expanded into model URLs, which are downloaded as a batch
+        if (query_params := parse_models_query_spec(url)) is not None:
+            if not self.batch_mode:
+                self.handle_loading_batch_urls_signal([url])
+            else:
+                self.start_models_query(url, query_params)
+            return
+
         if not self.batch_mode:
             self.clear_progress_bar()
-            self.download_failed_info.clear()
 
-        civitai_url_parser = CivitaiUrlParserRunner(url, self.httpx_client)
+        civitai_url_parser = CivitaiUrlParserRunner(url, self.request_client, self.api_single_flight)
         civitai_url_parser.signals.UrlParser_Preliminary_Signal.connect(self.handle_parser_preliminary_signal)
+        civitai_url_parser.signals.UrlParser_Warning_Signal.connect(self.handle_parser_warning_signal)
         civitai_url_parser.signals.UrlParser_Complete_Signal.connect(self.handle_parser_completed_signal)
 
-        self.pool.start(civitai_url_parser)
+        self.scheduler.submit(civitai_url_parser, priority=Priority.Normal if self.batch_mode else Priority.High)
+        self.thread_count += 1
+        self.parsing_count += 1
+
+    def start_models_query(self, spec: str, query_params: dict) -> None:
+        """
+        Page through the Models API (using QThreadPool), the found model URLs are streamed into the batch
+        :param spec: Like creator:username
+        :param query_params:
+        :return:
+        """
+        from helpmedownload.ModelsQuery import CivitaiModelsQueryRunner
+        self.operation_log.info(f'{spec} | Start to search models ...')
+        models_query = CivitaiModelsQueryRunner(spec, query_params, self.request_client, self.api_single_flight)
+        models_query.signals.ModelsQuery_Found_Signal.connect(self.handle_models_query_found_signal)
+        models_query.signals.ModelsQuery_Complete_Signal.connect(self.handle_models_query_completed_signal)
+        self.scheduler.submit(models_query, priority=Priority.Normal)
         self.thread_count += 1
+        self.parsing_count += 1
+
+    @Slot(tuple)
+    def handle_models_query_found_signal(self, found_info: tuple[str, list]) -> None:
+        _, model_urls = found_info
+        queued_urls = set(self.batch_url)
+        if new_urls := [url for url in model_urls if url not in queued_urls]:
+            self.update_running_batch_urls(self.batch_url + new_urls)
+
+    @Slot(tuple)
+    def handle_models_query_completed_signal(self, completed_info: tuple[str, int, str, list]) -> None:
+        spec, found_count, error_message, failed_specs = completed_info
+        self.thread_count -= 1
+        self.parsing_count -= 1
+
+        self.operation_log.info(f'{spec} | {found_count} model(s) found')
+        if error_message:
+            self.operation_log.warning(f'{spec} | {error_message} | {len(failed_specs)} part(s) to try again')
+        if self.job_journal:
+            # The query is expanded unless it has to be run again as a whole, its failed pages are kept as failures
+            if spec not in failed_specs:
+                self.job_journal.record('url_expanded', durable=True, url=spec)
+            for failed_spec in failed_specs:
+                self.job_journal.record('url_failed', durable=True, url=failed_spec)
+        self.batch_failed_urls.extend(failed_specs)
+
+        # The found URLs are waiting in the batch, nothing else picks them up if no parse is running
+        if not self.parsing_count:
+            self.continue_batch()
 
     @Slot(tuple)
     def handle_parser_preliminary_signal(self, message_info: tuple[str, str]) -> None:
         """
-        Display various messages (parsing status or errors) in the operation_text_browser.
+        Display various messages (parsing status or errors) in the operation log.
         :param message_info:
         :return:
         """
         message, url = message_info
 
         if message == 'Start':
-            self.ui.operation_text_browser.append(f'{url} | Start to parse ...')
+            self.operation_log.info(f'{url} | Start to parse ...')
             return
 
         self.thread_count -= 1
-        self.operation_browser_insert_html(f'<span style="color: pink;">{url} | {message}</span>')
+        self.parsing_count -= 1
+        self.operation_log.warning(f'{url} | {message}')
 
         if not self.batch_mode:
-            self.operation_browser_insert_html(
-                '<span style="color: pink;">'
-                'Confirm the URL. '
-                'If there are no errors, it may be due to a connection issue. Try again later'
-                '</span>'
+            self.operation_log.warning(
+                'Confirm the URL. If there are no errors, it may be due to a connection issue. Try again later'
             )
             self.enable_buttons_and_edit()
         else:
+            if self.job_journal:
+                self.job_journal.record('url_failed', durable=True, url=url)
             self.batch_failed_urls.append(url)
-            if self.batch_url:
-                self.download_from_batch_url()
+            self.continue_batch()
+
+    @Slot(tuple)
+    def handle_parser_warning_signal(self, message_info: tuple[str, str]) -> None:
+        message, url = message_info
+        self.operation_log.warning(f'{url} | {message}')
 
     @Slot(tuple)
     def handle_parser_completed_signal(self, completed_message: tuple) -> None:
@@ -171,78 +699,147 @@ class MainWindow(QMainWindow):
         model_name, version_info, url = completed_message
 
         self.thread_count -= 1
+        self.parsing_count -= 1
         if not version_info:
             if not self.batch_mode:
-                self.operation_browser_insert_html(
-                    f'<span style="color: pink;">{url} | Unable to retrieve content from the API. '
-                    f'Please check the URL.</span>'
-                )
+                self.operation_log.warning(f'{url} | Unable to retrieve content from the API. Please check the URL.')
                 self.enable_buttons_and_edit()
             else:
+                if self.job_journal:
+                    self.job_journal.record('url_failed', durable=True, url=url)
                 self.batch_failed_urls.append(url)
-                if self.batch_url:
-                    self.download_from_batch_url()
+                self.continue_batch()
+            return
+
+        if self.batch_mode and self.job_journal:
+            self.job_journal.record_parsed(url, version_info)
+        self.operation_log.info(f'{url} | Preparation complete. Start to download')
+        if self.start_to_download(version_info):
             return
 
-        self.ui.operation_text_browser.append(f'{url} | Preparation complete. Start to download')
-        self.start_to_download(version_info)
+        # Nothing new to download (every version is already scheduled or has no images)
+        self.operation_log.info(f'{url} | No new version to download')
+        if self.batch_mode:
+            self.continue_batch()
+        else:
+            self.enable_buttons_and_edit()
 
-    def start_to_download(self, version_info: dict[str, VersionInfoData]) -> None:
+    def start_to_download(self, version_info: dict[str, VersionInfoData]) -> int:
         """
         Start to download all images
         :param version_info:
-        :return:
+        :return: The number of versions scheduled
         """
+        from helpmedownload.ParserAndDownload import CivitaiImageDownloadRunner, get_version_save_dir
+        scheduled_count = 0
+        archive_writer = self.archive_writer if self.archive_layout else None
         for version_id, version_info_data in version_info.items():
             version_info_data: VersionInfoData
             # Skip versions that no longer have images available
             if not version_info_data.is_complete:
                 continue
+            # Skip versions that are already scheduled (a batch holding both the model URL and its version URLs)
+            if version_id in self.scheduled_version_ids:
+                continue
+            self.scheduled_version_ids.add(version_id)
+            scheduled_count += 1
 
             self.version_hyperlink[version_id] = version_info_data.hyperlink
-            model_name = version_info_data.model_name
+            self.version_model_id[version_id] = version_info_data.model_id
             version_name = version_info_data.name
             image_urls = version_info_data.image_urls
 
-            # Avoid recognizing the name as a folder during path concatenation when it contains / or \ in its name
-            model_name = model_name.replace('/', '_').replace('\\', '_')
-            dir_path = self.save_dir / Path(model_name) / Path(version_name)
-            dir_path.mkdir(parents=True, exist_ok=True)
+            dir_path = get_version_save_dir(self.save_dir, version_info_data)
+            # The archive writer creates the folder of the archive
+            if not self.archive_layout:
+                dir_path.mkdir(parents=True, exist_ok=True)
 
             self.add_progress_bar(version_id, version_name, len(image_urls))
-            self.download_failed_info[version_id] = []
+            # Keep the failures restored from the journal when resuming
+            self.download_failed_info.setdefault(version_id, [])
 
             for url in image_urls:
-                image_path = dir_path / url.split('/')[-1]
-                downloader = CivitaiImageDownloadRunner(version_id, version_name, url, image_path, self.httpx_client)
+                if self.batch_mode and self.job_journal:
+                    self.job_journal.record('image_start', version_id=version_id, url=url)
+                image_path = dir_path / self.image_variant_policy.file_name(url)
+                downloader = CivitaiImageDownloadRunner(version_id, version_name, url, image_path, self.request_client,
+                                                        request_url=self.image_variant_policy.rewrite_url(url),
+                                                        headers=self.image_variant_policy.request_headers,
+                                                        archive_writer=archive_writer,
+                                                        archive_layout=self.archive_layout)
                 downloader.signals.Image_Download_Fail_Signal.connect(self.handle_image_download_fail_signal)
                 downloader.signals.Image_Download_Complete_Signal.connect(self.handle_image_download_complete_signal)
-                self.pool.start(downloader)
+                self.scheduler.submit(downloader,
+                                      model_id=version_info_data.model_id,
+                                      version_id=version_id,
+                                      priority=Priority.Normal if self.batch_mode else Priority.High)
                 self.thread_count += 1
 
+        return scheduled_count
+
     def add_progress_bar(self, version_id: str, version_name: str, image_count: int) -> None:
         """
-        Create a QLabel and QProgressBar (both within a QHBoxLayout)
+        Create a QLabel, QProgressBar and a QToolButton for the job actions (all within a QHBoxLayout)
         :param version_id:
         :param version_name:
         :param image_count:
         :return:
         """
+        # The version is downloaded again (like new images found in Watch Mode), replace its old progress bar
+        self.remove_progress_bar(version_id)
+
         progress_layout = QHBoxLayout()
         progress_label = QLabel(version_name)
         progress_bar = QProgressBar(maximum=image_count)
+
+        job_button = QToolButton(text='...', popupMode=QToolButton.InstantPopup)
+        job_menu = QMenu(job_button)
+        model_id = self.version_model_id.get(version_id, '')
+        job_menu.addAction('Prioritize', lambda: self.scheduler.set_priority(Priority.High, version_id=version_id))
+        job_menu.addAction('Cancel Version', lambda: self.cancel_download_task(version_id=version_id))
+        job_menu.addAction('Cancel Model', lambda: self.cancel_download_task(model_id=model_id))
+        job_button.setMenu(job_menu)
+
         progress_layout.addWidget(progress_label)
         progress_layout.addWidget(progress_bar)
+        progress_layout.addWidget(job_button)
         progress_layout.setStretch(0, 1)
         progress_layout.setStretch(1, 5)
 
         self.progress_bar_info[version_id] = ProgressBarData(progress_layout=progress_layout,
+                                                             progress_label_widget=progress_label,
                                                              progress_bar_widget=progress_bar,
                                                              completed=0,
                                                              executed=0,
                                                              quantity=image_count)
         self.ui.verticalLayout.addLayout(progress_layout)
 
+    def cancel_download_task(self, model_id: str = '', version_id: str = '') -> None:
+        """
+        Remove the queued images of the model (or of the version) from the scheduler, the images that are
+        downloading are finished normally
+        :param model_id:
+        :param version_id:
+        :return:
+        """
+        cancelled_version_ids = []
+        for job in self.scheduler.cancel(model_id=model_id, version_id=version_id):
+            self.thread_count -= 1
+            bar_data: ProgressBarData = self.progress_bar_info[job.version_id]
+            bar_data.quantity -= 1
+            if self.batch_mode and self.job_journal:
+                self.job_journal.record('image_cancelled', version_id=job.version_id, url=job.runner.image_url)
+            if job.version_id in self.watch_version_ids:
+                self.watch_list.release(job.version_id, job.runner.image_url)
+            if job.version_id not in cancelled_version_ids:
+                cancelled_version_ids.append(job.version_id)
+
+        for cancelled_version_id in cancelled_version_ids:
+            bar_data: ProgressBarData = self.progress_bar_info[cancelled_version_id]
+            bar_data.progress_bar_widget.setMaximum(bar_data.quantity)
+            bar_data.progress_label_widget.setText(f'{bar_data.progress_label_widget.text()} (cancelled)')
+            self.handle_download_task(cancelled_version_id)
+
     @Slot(tuple)
     def handle_image_download_fail_signal(self, fail_info: tuple[str, str]) -> None:
         version_id, image_url = fail_info
@@ -251,14 +848,28 @@ class MainWindow(QMainWindow):
         bar_data: ProgressBarData = self.progress_bar_info[version_id]
         bar_data.executed += 1  # executed count
 
-        self.download_failed_info[version_id].append(image_url)
+        if self.batch_mode and self.job_journal:
+            self.job_journal.record('image_failed', version_id=version_id, url=image_url)
+        if version_id in self.watch_version_ids:
+            self.watch_list.release(version_id, image_url)
+        # The failures of a Watch Mode version are kept when the single URL / batch clears its own
+        self.download_failed_info.setdefault(version_id, []).append(image_url)
         self.handle_download_task(version_id)
 
     @Slot(tuple)
-    def handle_image_download_complete_signal(self, completed_info: tuple[str, str]) -> None:
-        version_id, _ = completed_info
+    def handle_image_download_complete_signal(self, completed_info: tuple[str, str, Path, str]) -> None:
+        version_id, image_url, image_path, sha256 = completed_info
         self.thread_count -= 1
 
+        if self.batch_mode and self.job_journal:
+            self.job_journal.record('image_done', version_id=version_id, url=image_url)
+        if version_id in self.watch_version_ids:
+            self.watch_list.mark_seen(version_id, image_url)
+
+        # Post-processing needs a loose file
+        if self.post_processor and not self.archive_layout:
+            self.post_processor.submit(image_path, sha256)
+
         bar_data: ProgressBarData = self.progress_bar_info[version_id]
         bar_data.executed += 1  # executed count
 
@@ -276,43 +887,56 @@ class MainWindow(QMainWindow):
         """
         bar_data: ProgressBarData = self.progress_bar_info[version_id]
         if bar_data.executed == bar_data.quantity:
-            self.ui.result_text_browser.append(
+            self.result_log.info(
                 f'{datetime.now().strftime("%m-%d %H:%M:%S")} '
                 f'Download task for "{self.version_hyperlink[version_id]}" has been completed.'
             )
 
-            if self.download_failed_info[version_id]:
-                self.ui.result_text_browser.insertHtml(
-                    '<br><span style="color: red;">'
-                    f'{self.version_hyperlink[version_id]}: {len(self.download_failed_info[version_id])} '
+            if failed_urls := self.download_failed_info.get(version_id):
+                self.result_log.error(
+                    f'{self.version_hyperlink[version_id]}: {len(failed_urls)} '
                     f'image(s) failed to download. '
-                    'Go to Show &gt; Show Failed URLs to view them.</span><br>'
+                    'Go to Show > Show Failed URLs to view them.'
                 )
+            self.forget_finished_version(version_id)
+
+            # A Watch Mode version leaves the URL field and the buttons to the single URL / batch
+            if version_id in self.watch_version_ids:
+                self.watch_version_ids.discard(version_id)
+                self.watch_list.save()
+                # The batch may only be waiting for this version
+                if self.batch_mode and not self.batch_url:
+                    self.continue_batch()
+                return
 
             if not self.batch_mode:
                 self.ui.url_line_edit.setText('')
                 self.enable_buttons_and_edit()
                 return
 
+            self.continue_batch()
+
+    def continue_batch(self) -> None:
+        """
+        Parse the next URL of the batch, or finish the batch if nothing is left
+        :return:
+        """
+        if self.batch_url:
+            self.download_from_batch_url()
+        elif not self.thread_count:
+            self.batch_mode = False
+            if self.job_journal:
+                self.job_journal.close(discard=True)
+                self.job_journal = None
+            self.batch_url = self.batch_failed_urls[:]
+            self.batch_failed_urls.clear()
+            self.started_batch_urls.clear()
+            self.enable_buttons_and_edit()
             if self.batch_url:
-                self.download_from_batch_url()
-            elif not self.thread_count:
-                self.batch_mode = False
-                self.batch_url = self.batch_failed_urls[:]
-                self.batch_failed_urls.clear()
-                self.enable_buttons_and_edit()
-                if self.batch_url:
-                    self.ui.result_text_browser.insertHtml(
-                        '<br><span style="color: red;">'
-                        f'{len(self.batch_url)}  failed model hyperlink(s),  re-add them to the batch list. '
-                        'Click the "Batch" button to view.</span><br>'
-                    )
-
-    def operation_browser_insert_html(self, html_string: str, newline_first: bool = True):
-        if newline_first:
-            self.ui.operation_text_browser.append('')
-        self.ui.operation_text_browser.insertHtml(html_string)
-        self.ui.operation_text_browser.setCurrentCharFormat(QTextCharFormat())
+                self.result_log.error(
+                    f'{len(self.batch_url)}  failed model hyperlink(s),  re-add them to the batch list. '
+                    'Click the "Batch" button to view.'
+                )
 
     @staticmethod
     def convert_failed_info_dict_to_list(download_failed_info: dict[str, list]) -> list:
@@ -329,21 +953,57 @@ class MainWindow(QMainWindow):
         :param enable:
         :return:
         """
-        self.ui.batch_push_button.setEnabled(enable)
+        # URLs can be added to a running batch
+        self.ui.batch_push_button.setEnabled(enable or self.batch_mode)
         self.ui.url_line_edit.setEnabled(enable)
         self.ui.go_push_button.setEnabled(enable)
 
+    def forget_finished_version(self, version_id: str) -> None:
+        """
+        Release what is kept per version once it is finished, so a long batch does not grow without limit.
+        The failed image URLs are kept (Show Failed URLs).
+        :param version_id:
+        :return:
+        """
+        self.version_hyperlink.pop(version_id, None)
+        self.version_model_id.pop(version_id, None)
+        if not self.download_failed_info.get(version_id, True):
+            del self.download_failed_info[version_id]
+
+        self.finished_version_ids.append(version_id)
+        if not self.batch_mode:
+            return
+        while len(self.finished_version_ids) > self.Max_Finished_Progress_Bars:
+            oldest_version_id = self.finished_version_ids.popleft()
+            bar_data: ProgressBarData | None = self.progress_bar_info.get(oldest_version_id)
+            # The version may be downloading again (Watch Mode)
+            if bar_data and bar_data.executed == bar_data.quantity:
+                self.remove_progress_bar(oldest_version_id)
+
+    def remove_progress_bar(self, version_id: str) -> None:
+        """
+        Remove the progress bar of the version (and its layout)
+        :param version_id:
+        :return:
+        """
+        if bar_data := self.progress_bar_info.pop(version_id, None):
+            self.clear_layout_widgets(bar_data.progress_layout)
+            self.ui.verticalLayout.removeItem(bar_data.progress_layout)
+            bar_data.progress_layout.deleteLater()
+
     def clear_progress_bar(self) -> None:
         """
-        Clear all progress bar layout
+        Clear all progress bar layout (and forget the versions they were scheduled for and their failures),
+        except the ones of the Watch Mode versions that are still downloading
         :return:
         """
-        if self.progress_bar_info:
-            for value in self.progress_bar_info.values():
-                value: ProgressBarData
-                layout = value.progress_layout
-                self.clear_layout_widgets(layout)
-            self.progress_bar_info.clear()
+        self.scheduled_version_ids.intersection_update(self.watch_version_ids)
+        self.download_failed_info = {version_id: failed_urls for version_id, failed_urls
+                                     in self.download_failed_info.items() if version_id in self.watch_version_ids}
+        self.finished_version_ids.clear()
+        for version_id in list(self.progress_bar_info):
+            if version_id not in self.watch_version_ids:
+                self.remove_progress_bar(version_id)
 
     def clear_layout_widgets(self, layout) -> None:
         """
@@ -359,4 +1019,13 @@ class MainWindow(QMainWindow):
                 self.clear_layout_widgets(item.layout())
 
     def clear_threadpool(self):
+        self.scheduler.clear()
         self.pool.clear()
+        # Keep the journal for resuming next time
+        if self.job_journal:
+            self.job_journal.close()
+        if self.post_processor:
+            self.post_processor.shutdown()
+        if self.archive_writer:
+            self.archive_writer.close()
+        self.toggle_log_file(False)
@@ -0,0 +1,97 @@
+import mimetypes
+from dataclasses import dataclass
+from urllib.parse import urlsplit, urlunsplit
+
+
+@dataclass(slots=True)
+class ImageVariantPolicy:
+    """
+    Which variant of the CDN image to download. The image URLs of civitai carry the variant options in the path,
+    like https://image.civitai.com/<key>/<uuid>/width=450/12345.jpeg (or original=true).
+    mode:
+        'as_is': Use the URL returned by the Images API
+        'original': The original upload
+        'max_width': At most max_width pixels wide
+    preferred_format: Ask for this format (like 'webp') through the Accept header, the server may ignore it
+    """
+    mode: str = 'as_is'
+    max_width: int = 0
+    preferred_format: str = ''
+
+    @staticmethod
+    def split_variant(url: str) -> tuple[list[str], int, dict[str, str]]:
+        """
+        :param url:
+        :return: (path segments, index of the variant segment (-1 if not found), variant options)
+        """
+        segments = urlsplit(url).path.split('/')
+        # The variant is the segment before the file name, comma separated key=value pairs
+        if len(segments) >= 3 and '=' in segments[-2]:
+            options = dict(option.split('=', 1) for option in segments[-2].split(',') if '=' in option)
+            return segments, len(segments) - 2, options
+        return segments, -1, {}
+
+    def rewrite_url(self, url: str) -> str:
+        """
+        Rewrite the variant segment of the URL according to the policy
+        :param url:
+        :return: The URL unchanged if the mode is 'as_is' or it is not a civitai CDN URL
+        """
+        if self.mode == 'as_is':
+            return url
+
+        segments, index, options = self.split_variant(url)
+        if index < 0:
+            return url
+
+        if self.mode == 'original':
+            options = {'original': 'true'}
+        elif self.mode == 'max_width':
+            width = options.get('width', '')
+            # Keep the smaller width, never ask for more than what the Images API offered
+            if options.get('original') == 'true' or not width.isdigit() or int(width) > self.max_width:
+                options.pop('original', None)
+                options['width'] = str(self.max_width)
+
+        segments[index] = ','.join(f'{key}={value}' for key, value in options.items())
+        parts = urlsplit(url)
+        return urlunsplit((parts.scheme, parts.netloc, '/'.join(segments), parts.query, parts.fragment))
+
+    def file_name(self, url: str) -> str:
+        """
+        The file name of the image, with the variant in it (like 12345_w450.webp), the default is unchanged
+        :param url: The URL returned by the Images API
+        :return:
+        """
+        name = url.split('/')[-1]
+        stem, dot, extension = name.rpartition('.')
+        if not dot:
+            stem, extension = name, ''
+
+        # Name the variant that is actually requested
+        _, index, options = self.split_variant(self.rewrite_url(url))
+        if index >= 0 and self.mode == 'original':
+            stem = f'{stem}_original'
+        elif index >= 0 and self.mode == 'max_width':
+            stem = f'{stem}_w{options.get("width", self.max_width)}'
+
+        if self.preferred_format:
+            extension = self.preferred_format
+        return f'{stem}.{extension}' if extension else stem
+
+    @property
+    def request_headers(self) -> dict[str, str]:
+        if not self.preferred_format:
+            return {}
+        return {'Accept': f'image/{self.preferred_format},image/*;q=0.8,*/*;q=0.5'}
+
+    @staticmethod
+    def extension_of(content_type: str) -> str:
+        """
+        :param content_type: Like 'image/webp; charset=...'
+        :return: Like '.webp', '' if unknown
+        """
+        mime_type = content_type.split(';')[0].strip().lower()
+        if mime_type == 'image/jpeg':
+            return '.jpeg'
+        return mimetypes.guess_extension(mime_type) or ''
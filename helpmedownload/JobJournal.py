@@ -0,0 +1,200 @@
+import os
+import json
+import time
+from pathlib import Path
+from dataclasses import dataclass, field, asdict, replace
+
+from helpmedownload.ParserAndDownload import VersionInfoData, FileInfoData
+
+
+@dataclass(slots=True)
+class JournalState:
+    save_dir: str = ''
+    queued_urls: list[str] = field(default_factory=list)
+    parsed: dict[str, dict[str, VersionInfoData]] = field(default_factory=dict)
+    finished_images: set[tuple[str, str]] = field(default_factory=set)
+    failed_images: dict[str, list] = field(default_factory=dict)
+    failed_urls: list[str] = field(default_factory=list)
+    cancelled_urls: set[str] = field(default_factory=set)
+    expanded_urls: set[str] = field(default_factory=set)
+    is_complete: bool = False
+
+    @property
+    def remaining_urls(self) -> list[str]:
+        """
+        URLs that have not been parsed (or expanded) yet
+        :return:
+        """
+        finished_urls = self.parsed.keys() | self.failed_urls | self.cancelled_urls | self.expanded_urls
+        # A URL found by several creator / tag queries is only queued once
+        return list(dict.fromkeys(url for url in self.queued_urls if url not in finished_urls))
+
+    @property
+    def remaining_version_info(self) -> dict[str, VersionInfoData]:
+        """
+        Parsed versions, only with the images that have not finished yet
+        :return:
+        """
+        remaining: dict[str, VersionInfoData] = {}
+        for version_info in self.parsed.values():
+            remaining.update(self.remaining_of(version_info))
+        return remaining
+
+    def remaining_of(self, version_info: dict[str, VersionInfoData]) -> dict[str, VersionInfoData]:
+        remaining: dict[str, VersionInfoData] = {}
+        for version_id, version_info_data in version_info.items():
+            if not version_info_data.is_complete:
+                continue
+            image_urls = [url for url in version_info_data.image_urls if (version_id, url) not in self.finished_images]
+            if image_urls:
+                remaining[version_id] = replace(version_info_data, image_urls=image_urls)
+        return remaining
+
+    @property
+    def remaining_image_count(self) -> int:
+        return sum(len(version_info_data.image_urls) for version_info_data in self.remaining_version_info.values())
+
+
+class JobJournal:
+    """
+    Write-ahead journal of a batch job (one json record per line), written before the state is changed in memory,
+    so that an interrupted batch can be resumed without parsing or downloading anything again.
+    Records:
+        {'event': 'batch', 'save_dir': str, 'urls': list}       queued
+        {'event': 'parsed', 'url': str, 'versions': dict}        parsed (with the image urls of each version)
+        {'event': 'url_failed', 'url': str}
+        {'event': 'url_cancelled', 'url': str}
+        {'event': 'url_expanded', 'url': str}                   creator / tag / query, its models are queued
+        {'event': 'image_start', 'version_id': str, 'url': str}  in-progress
+        {'event': 'image_done', 'version_id': str, 'url': str}   done
+        {'event': 'image_failed', 'version_id': str, 'url': str}
+        {'event': 'image_cancelled', 'version_id': str, 'url': str}
+        {'event': 'complete'}
+    """
+    Fsync_Interval: float = 0.5
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        self.file = self.path.open('a', encoding='utf-8')
+        self.last_fsync: float = 0.0
+
+    @classmethod
+    def create(cls, path: Path, save_dir: Path, urls: list[str]) -> 'JobJournal':
+        """
+        Start a new journal (the old one is discarded)
+        :param path:
+        :param save_dir:
+        :param urls:
+        :return:
+        """
+        path.unlink(missing_ok=True)
+        journal = cls(path)
+        journal.record('batch', durable=True, save_dir=str(save_dir), urls=urls)
+        return journal
+
+    @classmethod
+    def compact(cls, path: Path, state: JournalState) -> 'JobJournal':
+        """
+        Rewrite the journal with only the remaining work of the state, then continue to append to it
+        :param path:
+        :param state:
+        :return:
+        """
+        temp_path = path.with_suffix('.tmp')
+        with temp_path.open('w', encoding='utf-8') as f:
+            queued_urls = [url for url in state.queued_urls if url not in state.cancelled_urls]
+            f.write(json.dumps({'event': 'batch', 'save_dir': state.save_dir, 'urls': queued_urls}) + '\n')
+            for url in state.failed_urls:
+                f.write(json.dumps({'event': 'url_failed', 'url': url}) + '\n')
+            for url in state.expanded_urls:
+                f.write(json.dumps({'event': 'url_expanded', 'url': url}) + '\n')
+            # Finished images are dropped from the parsed versions, only the failed ones are kept for the report
+            for url, version_info in state.parsed.items():
+                versions = {version_id: asdict(data) for version_id, data in state.remaining_of(version_info).items()}
+                f.write(json.dumps({'event': 'parsed', 'url': url, 'versions': versions}) + '\n')
+            for version_id, image_urls in state.failed_images.items():
+                for image_url in image_urls:
+                    f.write(json.dumps({'event': 'image_failed', 'version_id': version_id, 'url': image_url}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        return cls(path)
+
+    def record(self, event: str, durable: bool = False, **data) -> None:
+        """
+        Append a record. Batch-level records are always fsynced, image records are fsynced at most every
+        Fsync_Interval seconds (at worst, a few images are downloaded again after a power loss)
+        :param event:
+        :param durable: fsync immediately
+        :param data:
+        :return:
+        """
+        self.file.write(json.dumps({'event': event, **data}) + '\n')
+        self.file.flush()
+        if durable or time.monotonic() - self.last_fsync >= self.Fsync_Interval:
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.monotonic()
+
+    def record_parsed(self, url: str, version_info: dict[str, VersionInfoData]) -> None:
+        versions = {version_id: asdict(version_info_data) for version_id, version_info_data in version_info.items()}
+        self.record('parsed', durable=True, url=url, versions=versions)
+
+    def close(self, discard: bool = False) -> None:
+        """
+        :param discard: Remove the journal, use it after the batch has finished
+        :return:
+        """
+        if discard:
+            self.record('complete', durable=True)
+        self.file.close()
+        if discard:
+            self.path.unlink(missing_ok=True)
+
+    @staticmethod
+    def replay(path: Path) -> JournalState | None:
+        """
+        Rebuild the state of the batch from the journal. A torn last line (crash while writing) is ignored.
+        :param path:
+        :return: None if there is no journal
+        """
+        if not path.exists():
+            return None
+
+        state = JournalState()
+        with path.open('r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                match record['event']:
+                    case 'batch':
+                        state.save_dir = record['save_dir']
+                        state.queued_urls.extend(record['urls'])
+                        state.cancelled_urls.difference_update(record['urls'])
+                    case 'parsed':
+                        state.parsed[record['url']] = {
+                            version_id: JobJournal.version_info_data_from_dict(data)
+                            for version_id, data in record['versions'].items()
+                        }
+                    case 'url_failed':
+                        state.failed_urls.append(record['url'])
+                    case 'url_cancelled':
+                        state.cancelled_urls.add(record['url'])
+                    case 'url_expanded':
+                        state.expanded_urls.add(record['url'])
+                    case 'image_done' | 'image_cancelled':
+                        state.finished_images.add((record['version_id'], record['url']))
+                    case 'image_failed':
+                        state.finished_images.add((record['version_id'], record['url']))
+                        state.failed_images.setdefault(record['version_id'], []).append(record['url'])
+                    case 'complete':
+                        state.is_complete = True
+
+        return state
+
+    @staticmethod
+    def version_info_data_from_dict(data: dict) -> VersionInfoData:
+        file_info = {file_id: FileInfoData(**file_data) for file_id, file_data in data.pop('file_info', {}).items()}
+        return VersionInfoData(**data, file_info=file_info)
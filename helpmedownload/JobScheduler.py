@@ -0,0 +1,143 @@
+import heapq
+import itertools
+from dataclasses import dataclass, field
+
+from PySide6.QtCore import QObject, Signal, QRunnable, QThreadPool, Slot
+
+
+class Priority:
+    High: int = 0
+    Normal: int = 1
+    Low: int = 2
+
+
+@dataclass(order=True, slots=True)
+class ScheduledJob:
+    priority: int
+    sequence: int
+    job_id: int = field(compare=False)
+    model_id: str = field(compare=False)
+    version_id: str = field(compare=False)
+    runner: QRunnable = field(compare=False)
+
+
+class ScheduledRunnerSignals(QObject):
+    """
+    Signals for ScheduledRunner class
+    """
+    Job_Finished_Signal = Signal(int)
+
+
+class ScheduledRunner(QRunnable):
+    """
+    Run the runner of a job, then report to the scheduler that a worker is free again
+    """
+    def __init__(self, job: ScheduledJob, signals: ScheduledRunnerSignals) -> None:
+        super().__init__()
+        self.job = job
+        self.signals = signals
+
+    @Slot()
+    def run(self) -> None:
+        try:
+            self.job.runner.run()
+        finally:
+            self.signals.Job_Finished_Signal.emit(self.job.job_id)
+
+
+class JobScheduler(QObject):
+    """
+    Priority queue in front of the QThreadPool. Only as many jobs as the pool has threads are handed over,
+    so the queued jobs can still be paused, re-prioritized or cancelled (per model / per version).
+    Must be used from the main thread.
+    """
+    def __init__(self, pool: QThreadPool, parent=None) -> None:
+        super().__init__(parent)
+        self.pool: QThreadPool = pool
+        self.queue: list[ScheduledJob] = []
+        self.running: dict[int, ScheduledJob] = {}
+        self.is_paused: bool = False
+        self.job_ids = itertools.count()
+        self.sequence = itertools.count()
+
+        self.signals = ScheduledRunnerSignals()
+        self.signals.Job_Finished_Signal.connect(self.handle_job_finished_signal)
+
+    def submit(self, runner: QRunnable, model_id: str = '', version_id: str = '',
+               priority: int = Priority.Normal) -> None:
+        """
+        Queue the runner, jobs with the same priority are started in the order they were submitted
+        :param runner:
+        :param model_id:
+        :param version_id:
+        :param priority:
+        :return:
+        """
+        heapq.heappush(self.queue, ScheduledJob(priority=priority,
+                                                sequence=next(self.sequence),
+                                                job_id=next(self.job_ids),
+                                                model_id=model_id,
+                                                version_id=version_id,
+                                                runner=runner))
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """
+        Hand the queued jobs over to the pool until every thread is busy
+        :return:
+        """
+        while not self.is_paused and self.queue and len(self.running) < self.pool.maxThreadCount():
+            job = heapq.heappop(self.queue)
+            self.running[job.job_id] = job
+            self.pool.start(ScheduledRunner(job, self.signals))
+
+    @Slot(int)
+    def handle_job_finished_signal(self, job_id: int) -> None:
+        self.running.pop(job_id, None)
+        self.dispatch()
+
+    def pause(self) -> None:
+        """
+        Stop starting new jobs, the running ones (and the connections of the httpx client) are kept
+        :return:
+        """
+        self.is_paused = True
+
+    def resume(self) -> None:
+        self.is_paused = False
+        self.dispatch()
+
+    def cancel(self, model_id: str = '', version_id: str = '') -> list[ScheduledJob]:
+        """
+        Remove the queued jobs of the model (or of the version). The running ones are not interrupted.
+        :param model_id:
+        :param version_id:
+        :return: The removed jobs
+        """
+        removed = [job for job in self.queue if self.is_matched(job, model_id, version_id)]
+        if removed:
+            self.queue = [job for job in self.queue if not self.is_matched(job, model_id, version_id)]
+            heapq.heapify(self.queue)
+        return removed
+
+    def set_priority(self, priority: int, model_id: str = '', version_id: str = '') -> None:
+        """
+        Change the priority of the queued jobs of the model (or of the version)
+        :param priority:
+        :param model_id:
+        :param version_id:
+        :return:
+        """
+        for job in self.queue:
+            if self.is_matched(job, model_id, version_id):
+                job.priority = priority
+        heapq.heapify(self.queue)
+
+    @staticmethod
+    def is_matched(job: ScheduledJob, model_id: str, version_id: str) -> bool:
+        if version_id:
+            return job.version_id == version_id
+        return bool(model_id) and job.model_id == model_id
+
+    def clear(self) -> None:
+        self.queue.clear()
@@ -0,0 +1,97 @@
+import json
+from typing import Any, Callable
+
+# Optional faster backends (pip3 install orjson / msgspec), the standard json module is used without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+if orjson:
+    Backend_Name: str = 'orjson'
+    decode_json: Callable[[bytes | str], Any] = orjson.loads
+elif msgspec:
+    Backend_Name = 'msgspec'
+    decode_json = msgspec.json.decode
+else:
+    Backend_Name = 'json'
+    decode_json = json.loads
+
+
+if msgspec:
+    # Only the fields used by VersionInfoData / FileInfoData (and the paging), msgspec skips the others
+    # without creating them (images, stats, descriptions, ...)
+    class ModelFileStruct(msgspec.Struct):
+        id: int
+        name: str = ''
+        metadata: dict = {}
+        downloadUrl: str = ''
+        sizeKB: float = 0.0
+        hashes: dict = {}
+        primary: bool = False
+
+    class ModelVersionStruct(msgspec.Struct):
+        id: int
+        name: str = ''
+        files: list[ModelFileStruct] = []
+
+    class CreatorStruct(msgspec.Struct):
+        username: str = ''
+
+    class ModelStruct(msgspec.Struct):
+        name: str
+        creator: CreatorStruct = msgspec.field(default_factory=CreatorStruct)
+        modelVersions: list[ModelVersionStruct] = []
+
+    class ImageStruct(msgspec.Struct):
+        url: str | None = None
+
+    class ImagesPageStruct(msgspec.Struct):
+        items: list[ImageStruct] = []
+        metadata: dict = {}
+
+    class ModelIdStruct(msgspec.Struct):
+        id: int
+
+    class ModelsPageStruct(msgspec.Struct):
+        items: list[ModelIdStruct] = []
+        metadata: dict = {}
+
+
+def struct_decoder(struct_type: type) -> Callable[[bytes | str], Any]:
+    """
+    A decoder that only keeps the fields of the struct (as dicts and lists, like decode_json would return).
+    If the payload does not fit the struct (an API change, null where an object is expected), everything is decoded.
+    :param struct_type: Like ModelStruct
+    :return:
+    """
+    decoder = msgspec.json.Decoder(struct_type)
+
+    def decode(data: bytes | str) -> Any:
+        try:
+            return msgspec.to_builtins(decoder.decode(data))
+        except msgspec.DecodeError:
+            return decode_json(data)
+
+    return decode
+
+
+# Models API (/api/v1/models/<id>), Images API and the paged Models API (/api/v1/models?...)
+if msgspec:
+    decode_model_json = struct_decoder(ModelStruct)
+    decode_images_json = struct_decoder(ImagesPageStruct)
+    decode_models_page_json = struct_decoder(ModelsPageStruct)
+else:
+    decode_model_json = decode_images_json = decode_models_page_json = decode_json
+
+
+if __name__ == '__main__':
+    print(f'Backend: {Backend_Name}, field extraction: {"msgspec" if msgspec else "no (decodes everything)"}')
+    sample = b'{"name": "m", "creator": {"username": "c"}, "stats": {"downloadCount": 1}, ' \
+             b'"modelVersions": [{"id": 1, "name": "v1", "images": [], "files": [{"id": 2, "name": "f"}]}]}'
+    print(decode_model_json(sample))
@@ -0,0 +1,211 @@
+import re
+import queue
+import logging
+from collections import deque
+from datetime import datetime
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from PySide6.QtCore import (QAbstractListModel, QModelIndex, QSortFilterProxyModel, QTimer, Qt, QUrl,
+                            QPersistentModelIndex)
+from PySide6.QtGui import QColor, QDesktopServices
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QListView, QComboBox
+
+if TYPE_CHECKING:
+    from logging.handlers import QueueListener
+
+
+@dataclass(slots=True)
+class LogRecordData:
+    time: datetime
+    level: int
+    text: str
+
+
+class LogModel(QAbstractListModel):
+    """
+    Ring buffer of the log records (at most max_lines, the oldest ones are dropped).
+    Records are appended in batches (every Flush_Interval_Milliseconds), so a burst of messages
+    costs one model update instead of one per message.
+    """
+    Flush_Interval_Milliseconds: int = 100
+    Level_Colors: dict[int, QColor] = {
+        logging.WARNING: QColor('pink'),
+        logging.ERROR: QColor('red'),
+    }
+
+    def __init__(self, max_lines: int = 5000, parent=None) -> None:
+        super().__init__(parent)
+        self.records: deque[LogRecordData] = deque(maxlen=max_lines)
+        self.pending_records: list[LogRecordData] = []
+        self.flush_timer = QTimer(self, singleShot=True, interval=self.Flush_Interval_Milliseconds)
+        self.flush_timer.timeout.connect(self.flush)
+
+        self.file_logger: logging.Logger | None = None
+        self.file_listener: QueueListener | None = None
+
+    def rowCount(self, parent: QModelIndex | QPersistentModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.records)
+
+    def data(self, index: QModelIndex | QPersistentModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self.records[index.row()]
+        if role == Qt.DisplayRole:
+            return record.text
+        if role == Qt.ForegroundRole:
+            return self.Level_Colors.get(record.level)
+        if role == Qt.ToolTipRole:
+            return f'{record.time.strftime("%m-%d %H:%M:%S")} {logging.getLevelName(record.level)}'
+        if role == Qt.UserRole:
+            return record.level
+        return None
+
+    def log(self, level: int, text: str) -> None:
+        record = LogRecordData(time=datetime.now(), level=level, text=text)
+        self.pending_records.append(record)
+        if self.file_logger:
+            self.file_logger.log(level, text)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush(self) -> None:
+        """
+        Move the pending records into the ring buffer
+        :return:
+        """
+        if not self.pending_records:
+            return
+        max_lines = self.records.maxlen
+        new_records, self.pending_records = self.pending_records[-max_lines:], []
+
+        # Remove the overflow explicitly, the views must know about the rows dropped by the deque
+        if (overflow := len(self.records) + len(new_records) - max_lines) > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            for _ in range(overflow):
+                self.records.popleft()
+            self.endRemoveRows()
+
+        first_row = len(self.records)
+        self.beginInsertRows(QModelIndex(), first_row, first_row + len(new_records) - 1)
+        self.records.extend(new_records)
+        self.endInsertRows()
+
+    def clear(self) -> None:
+        self.beginResetModel()
+        self.records.clear()
+        self.pending_records.clear()
+        self.endResetModel()
+
+    def enable_file_mirror(self, log_path: Path, max_bytes: int = 5 * 1024 * 1024, backup_count: int = 3) -> None:
+        """
+        Mirror the records to a rotating log file, the file is written by a background thread
+        :param log_path:
+        :param max_bytes:
+        :param backup_count:
+        :return:
+        """
+        if self.file_logger:
+            return
+        # Imported only when needed, it is slow to import (socket, pickle, ...)
+        from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+        file_handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+        record_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.file_listener = QueueListener(record_queue, file_handler)
+        self.file_listener.start()
+
+        self.file_logger = logging.getLogger(f'helpmedownload.{self.objectName() or id(self)}')
+        self.file_logger.setLevel(logging.DEBUG)
+        self.file_logger.propagate = False
+        self.file_logger.addHandler(QueueHandler(record_queue))
+
+    def disable_file_mirror(self) -> None:
+        if not self.file_logger:
+            return
+        self.file_listener.stop()
+        for handler in self.file_logger.handlers[:]:
+            self.file_logger.removeHandler(handler)
+        for handler in self.file_listener.handlers:
+            handler.close()
+        self.file_logger, self.file_listener = None, None
+
+
+class LogLevelFilterModel(QSortFilterProxyModel):
+    """
+    Only show the records at or above minimum_level
+    """
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self.minimum_level: int = logging.DEBUG
+
+    def set_minimum_level(self, level: int) -> None:
+        self.minimum_level = level
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row: int, source_parent: QModelIndex | QPersistentModelIndex) -> bool:
+        index = self.sourceModel().index(source_row, 0, source_parent)
+        return self.sourceModel().data(index, Qt.UserRole) >= self.minimum_level
+
+
+class LogView(QWidget):
+    """
+    Log viewer (a QListView renders only the visible rows), with a level filter.
+    Double-click a line to open the first URL in it.
+    """
+    Url_Pattern = re.compile(r'https?://\S+?(?=["\s]|$)')
+
+    def __init__(self, max_lines: int = 5000, parent=None) -> None:
+        super().__init__(parent)
+        self.model = LogModel(max_lines=max_lines, parent=self)
+        self.filter_model = LogLevelFilterModel(self)
+        self.filter_model.setSourceModel(self.model)
+
+        v_layout = QVBoxLayout(self)
+        v_layout.setContentsMargins(0, 0, 0, 0)
+        h_layout = QHBoxLayout()
+        h_layout.addStretch(1)
+        self.level_combo_box = QComboBox(self)
+        for text, level in (('All', logging.DEBUG), ('Warnings', logging.WARNING), ('Errors', logging.ERROR)):
+            self.level_combo_box.addItem(text, level)
+        self.level_combo_box.currentIndexChanged.connect(
+            lambda _: self.filter_model.set_minimum_level(self.level_combo_box.currentData())
+        )
+        h_layout.addWidget(self.level_combo_box)
+        v_layout.addLayout(h_layout)
+
+        self.list_view = QListView(self)
+        self.list_view.setModel(self.filter_model)
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setWordWrap(False)
+        self.list_view.setEditTriggers(QListView.NoEditTriggers)
+        self.list_view.setSelectionMode(QListView.ExtendedSelection)
+        self.list_view.doubleClicked.connect(self.open_url_of_index)
+        v_layout.addWidget(self.list_view)
+
+        # Follow the new lines, unless the user has scrolled up
+        self.is_following = True
+        self.list_view.verticalScrollBar().valueChanged.connect(self.update_following)
+        self.filter_model.rowsInserted.connect(self.scroll_to_bottom_if_following)
+
+    def update_following(self, value: int) -> None:
+        self.is_following = value == self.list_view.verticalScrollBar().maximum()
+
+    def scroll_to_bottom_if_following(self) -> None:
+        if self.is_following:
+            self.list_view.scrollToBottom()
+
+    def open_url_of_index(self, index: QModelIndex) -> None:
+        if match := self.Url_Pattern.search(index.data(Qt.DisplayRole) or ''):
+            QDesktopServices.openUrl(QUrl(match.group()))
+
+    def info(self, text: str) -> None:
+        self.model.log(logging.INFO, text)
+
+    def warning(self, text: str) -> None:
+        self.model.log(logging.WARNING, text)
+
+    def error(self, text: str) -> None:
+        self.model.log(logging.ERROR, text)
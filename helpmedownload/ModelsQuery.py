@@ -0,0 +1,143 @@
+import re
+import threading
+from urllib.parse import parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import httpx
+from PySide6.QtCore import QObject, Signal, QRunnable, Slot
+
+from helpmedownload.ParserAndDownload import CivitaiUrlParserRunner
+from helpmedownload.SingleFlight import SingleFlight
+from helpmedownload.JsonDecoding import decode_models_page_json
+
+
+Models_Query_Pattern = re.compile(r'(?P<kind>creator|tag|query|api):(?P<value>\S.*)$'
+                                  r'|https://civitai\.com/user/(?P<username>[\w.-]+)/?(?:models)?/?$')
+
+
+def parse_models_query_spec(text: str) -> dict | None:
+    """
+    Convert an input line into the params of the Models API
+        creator:<username> or https://civitai.com/user/<username>
+        tag:<tag>
+        query:<search text>
+        api:<query string of the Models API, like types=LORA&sort=Newest&username=abc>
+    :param text:
+    :return: None if it is not a models query (a model or version URL, for example)
+    """
+    if not (match := Models_Query_Pattern.match(text.strip())):
+        return None
+    if match['username']:
+        return {'username': match['username']}
+
+    value = match['value'].strip()
+    match match['kind']:
+        case 'creator':
+            return {'username': value}
+        case 'tag':
+            return {'tag': value}
+        case 'query':
+            return {'query': value}
+        case _:
+            return dict(parse_qsl(value.lstrip('?'))) or None
+
+
+class CivitaiModelsQueryRunnerSignals(QObject):
+    """
+    Signals for CivitaiModelsQueryRunner class
+    """
+    ModelsQuery_Found_Signal = Signal(tuple)
+    ModelsQuery_Complete_Signal = Signal(tuple)
+
+
+class CivitaiModelsQueryRunner(QRunnable):
+    """
+    Expand a creator / tag / query into model URLs by paging through the Models API.
+    Every page is emitted as soon as it arrives (ModelsQuery_Found_Signal), nothing is collected first.
+    With page numbers, the pages after the first one are fetched concurrently, with a cursor (search queries)
+    they are followed one by one. A query with a page param (api:...&page=3) only gets that page.
+    Emits (spec, found count, error message, [specs to try again]) when finished, the failed pages are given
+    as api:...&page=N specs (or the spec itself if they can't be fetched alone).
+    """
+    Page_Size: int = 100
+    Max_Concurrent_Pages: int = 4
+    Page_Errors: tuple[type[Exception], ...] = (httpx.TimeoutException, httpx.RequestError, AssertionError, ValueError)
+
+    def __init__(self, spec: str, params: dict, httpx_client: httpx.Client,
+                 single_flight: SingleFlight | None = None) -> None:
+        super().__init__()
+        self.spec: str = spec
+        self.params: dict = {'limit': self.Page_Size, **params}
+        self.httpx_client: httpx.Client = httpx_client
+        self.single_flight: SingleFlight = single_flight or SingleFlight()
+        self.models_api: str = CivitaiUrlParserRunner.Civitai_Models_API.rstrip('/')
+        self.found_count: int = 0
+        self.found_count_lock = threading.Lock()
+        self.signals = CivitaiModelsQueryRunnerSignals()
+
+    @Slot()
+    def run(self) -> None:
+        error_message = ''
+        failed_specs: list[str] = []
+        try:
+            metadata = self.fetch_page(self.models_api, self.params)
+            total_pages = metadata.get('totalPages') or 0
+            # With a page param, only that page is wanted (like a failed page of an earlier query)
+            if 'page' in self.params:
+                pass
+            elif total_pages > 1 and 'query' not in self.params:
+                failed_pages, error_message = self.fetch_pages_concurrently(total_pages)
+                failed_specs = [self.page_spec(page) for page in failed_pages]
+            else:
+                while next_page := metadata.get('nextPage'):
+                    metadata = self.fetch_page(next_page, {})
+        except self.Page_Errors as e:
+            error_message = str(e)
+            failed_specs = [self.spec]
+
+        self.signals.ModelsQuery_Complete_Signal.emit((self.spec, self.found_count, error_message, failed_specs))
+
+    def page_spec(self, page: int) -> str:
+        """
+        :param page:
+        :return: Like api:limit=100&username=abc&page=3
+        """
+        return f'api:{urlencode({**self.params, "page": page})}'
+
+    def fetch_page(self, url: str, params: dict) -> dict:
+        """
+        Get one page and emit its model URLs
+        :param url:
+        :param params:
+        :return: The metadata of the page
+        """
+        def fetch() -> dict:
+            response = self.httpx_client.get(url, params=params)
+            assert (response.status_code == httpx.codes.OK), 'Response code is not OK when trying to get models'
+            return decode_models_page_json(response.content)
+
+        page_data = self.single_flight.do(('GET', url, tuple(sorted(params.items()))), fetch)
+        model_urls = [f'https://civitai.com/models/{model["id"]}' for model in page_data.get('items', [])]
+        if model_urls:
+            with self.found_count_lock:
+                self.found_count += len(model_urls)
+            self.signals.ModelsQuery_Found_Signal.emit((self.spec, model_urls))
+        return page_data.get('metadata', {})
+
+    def fetch_pages_concurrently(self, total_pages: int) -> tuple[list[int], str]:
+        """
+        Get the pages 2 to total_pages, a failed page does not stop the others
+        :param total_pages:
+        :return: (the failed page numbers, the first error message)
+        """
+        failed_pages, error_message = [], ''
+        with ThreadPoolExecutor(max_workers=self.Max_Concurrent_Pages) as executor:
+            futures = {executor.submit(self.fetch_page, self.models_api, {**self.params, 'page': page}): page
+                       for page in range(2, total_pages + 1)}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except self.Page_Errors as e:
+                    failed_pages.append(futures[future])
+                    error_message = error_message or str(e)
+        return sorted(failed_pages), error_message
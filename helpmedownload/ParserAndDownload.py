@@ -1,10 +1,19 @@
+import os
 import re
+import tempfile
 from pathlib import Path
 from dataclasses import dataclass, field
+from typing import Any, Callable
 
 import httpx
 from PySide6.QtCore import QObject, Signal, QRunnable, Slot
 
+from helpmedownload.SingleFlight import SingleFlight
+from helpmedownload.ImageVariant import ImageVariantPolicy
+from helpmedownload.Checksum import StreamingDigests, ChecksumIndex, mismatched_hashes
+from helpmedownload.JsonDecoding import decode_json, decode_model_json, decode_images_json
+from helpmedownload.ArchiveOutput import ArchiveWriter
+
 
 @dataclass(slots=True)
 class UrlParseResultData:
@@ -20,6 +29,8 @@ class FileInfoData:
     url: str
     size: int
     is_default: bool
+    # Like {'SHA256': ..., 'AutoV2': ..., 'BLAKE3': ..., 'CRC32': ...}
+    hashes: dict[str, str] = field(default_factory=dict)
 
 
 @dataclass(slots=True)
@@ -34,11 +45,25 @@ class VersionInfoData:
     is_complete: bool = False
 
 
+def get_version_save_dir(save_dir: Path, version_info_data: VersionInfoData) -> Path:
+    """
+    The folder of the version images, save_dir/model_name/version_name
+    :param save_dir:
+    :param version_info_data:
+    :return:
+    """
+    # Avoid recognizing the name as a folder during path concatenation when it contains / or \ in its name
+    model_name = version_info_data.model_name.replace('/', '_').replace('\\', '_')
+    return save_dir / Path(model_name) / Path(version_info_data.name)
+
+
 class CivitaiUrlParserRunnerSignals(QObject):
     """
     Signals for CivitaiUrlParserRunner class
     """
     UrlParser_Preliminary_Signal = Signal(tuple)
+    # Errors that do not stop the parsing (like the images of one version), UrlParser_Complete_Signal still follows
+    UrlParser_Warning_Signal = Signal(tuple)
     UrlParser_Complete_Signal = Signal(tuple)
 
 
@@ -49,11 +74,13 @@ class CivitaiUrlParserRunner(QRunnable):
     Civitai_Models_API: str = r'https://civitai.com/api/v1/models/'
     Civitai_Images_API: str = r'https://civitai.com/api/v1/images'
     
-    def __init__(self, url: str, httpx_client: httpx.Client) -> None:
+    def __init__(self, url: str, httpx_client: httpx.Client, single_flight: SingleFlight | None = None) -> None:
         super().__init__()
 
         self.url: str = url
         self.httpx_client: httpx.Client = httpx_client
+        # Share identical API requests with the other runners (for example, a model URL and its version URLs)
+        self.single_flight: SingleFlight = single_flight or SingleFlight()
 
         self.version_info: dict[str, VersionInfoData] = {}
         self.signals = CivitaiUrlParserRunnerSignals()
@@ -66,6 +93,24 @@ class CivitaiUrlParserRunner(QRunnable):
         if parse_result.is_valid:
             self.get_version_info(parse_result)
 
+    def get_api_json(self, url: str, params: dict, error_message: str,
+                     decode: Callable[[bytes], Any] = decode_json) -> dict:
+        """
+        GET the API and decode the json. Identical requests in flight at the same time share one network call
+        and one decoded result, so the result must not be modified.
+        :param url:
+        :param params:
+        :param error_message: Message of the AssertionError if the response code is not OK
+        :param decode: Like decode_model_json, which only keeps the fields that are used
+        :return:
+        """
+        def fetch() -> dict:
+            response = self.httpx_client.get(url, params=params)
+            assert (response.status_code == httpx.codes.OK), error_message
+            return decode(response.content)
+
+        return self.single_flight.do(('GET', url, tuple(sorted(params.items()))), fetch)
+
     def get_model_and_version_id(self) -> UrlParseResultData:
         """
         Get the analysis result and connection status of the URL, and emit the information (message, url)
@@ -73,12 +118,14 @@ class CivitaiUrlParserRunner(QRunnable):
         :return: UrlParseResultData
         """
         try:
-            if self.httpx_client.get(self.url).status_code == httpx.codes.OK:
-                if match := re.search(r'models/(?P<model_id>\d{4,6})[?]modelVersionId=(?P<version_id>\d{4,6})',
+            status_code = self.single_flight.do(('GET', self.url),
+                                                lambda: self.httpx_client.get(self.url).status_code)
+            if status_code == httpx.codes.OK:
+                if match := re.search(r'models/(?P<model_id>\d+)[?]modelVersionId=(?P<version_id>\d+)',
                                       self.url):
                     model_id, version_id = match['model_id'], match['version_id']
                     return UrlParseResultData(model_id=model_id, version_id=version_id, is_valid=True)
-                elif match := re.search(r'models/(?P<model_id>\d{4,6})/?', self.url):
+                elif match := re.search(r'models/(?P<model_id>\d+)/?', self.url):
                     model_id = match['model_id']
                     return UrlParseResultData(model_id=model_id, is_valid=True)
                 else:
@@ -86,10 +133,11 @@ class CivitaiUrlParserRunner(QRunnable):
                     error_message = 'Parse failed.(not a valid civitai.com link)'
                     self.signals.UrlParser_Preliminary_Signal.emit((error_message, self.url))
                     return UrlParseResultData(is_valid=False)
+            error_message = f'Response code is {status_code} when trying to open the URL'
         except (httpx.TimeoutException, httpx.RequestError, httpx.ReadTimeout) as e:
             error_message = str(e)
-            self.signals.UrlParser_Preliminary_Signal.emit((error_message, self.url))
-            return UrlParseResultData(is_valid=False)
+        self.signals.UrlParser_Preliminary_Signal.emit((error_message, self.url))
+        return UrlParseResultData(is_valid=False)
 
     def get_version_info(self, parse_result: UrlParseResultData) -> None:
         """
@@ -101,14 +149,14 @@ class CivitaiUrlParserRunner(QRunnable):
         model_id = parse_result.model_id
         specific_version_id = parse_result.version_id
         try:
-            response = self.httpx_client.get(self.Civitai_Models_API + model_id)
-            assert (response.status_code == httpx.codes.OK), 'Response code is not OK when trying to get version info'
+            model_data = self.get_api_json(self.Civitai_Models_API + model_id, {},
+                                           'Response code is not OK when trying to get version info',
+                                           decode=decode_model_json)
         except (httpx.TimeoutException, httpx.RequestError, httpx.ReadTimeout, AssertionError) as e:
             error_message = str(e)
             self.signals.UrlParser_Preliminary_Signal.emit((error_message, self.url))
             return
 
-        model_data = response.json()
         model_name = model_data['name']
         creator_name = model_data['creator']['username']
 
@@ -186,7 +234,8 @@ class CivitaiUrlParserRunner(QRunnable):
                 info='-'.join(str(file['metadata'].values())),
                 url=file['downloadUrl'],
                 size=file['sizeKB'],
-                is_default=file.get('primary', False)
+                is_default=file.get('primary', False),
+                hashes=file.get('hashes', {})
             )
 
         return file_info
@@ -204,14 +253,14 @@ class CivitaiUrlParserRunner(QRunnable):
         }
 
         try:
-            response = self.httpx_client.get(self.Civitai_Images_API, params=params)
-            assert (response.status_code == httpx.codes.OK), 'Response code is not OK when trying to get image url info'
+            image_data = self.get_api_json(self.Civitai_Images_API, params,
+                                           'Response code is not OK when trying to get image url info',
+                                           decode=decode_images_json)
         except (httpx.TimeoutException, httpx.RequestError, httpx.ReadTimeout, AssertionError) as e:
             error_message = str(e)
-            self.signals.UrlParser_Preliminary_Signal.emit((error_message, self.url))
+            self.signals.UrlParser_Warning_Signal.emit((error_message, self.url))
             return image_urls, False
 
-        image_data = response.json()
         for image_info in image_data.get('items'):
             url = image_info.get('url')
             image_urls.append(url)
@@ -229,34 +278,50 @@ class CivitaiImageDownloadRunnerSignals(QObject):
 
 class CivitaiImageDownloadRunner(QRunnable):
     """
-    Download images with support for QThreadPool
+    Download images with support for QThreadPool.
+    The digests are computed while the bytes are written and recorded in the checksum index of the folder.
+    If they do not match expected_hashes, the file is fetched again (at most Max_Attempts times). The images have no
+    expected hashes (the Images API gives none), it is meant for the model files, whose hashes are in FileInfoData.
+    With archive_writer, the image is appended to the tar archive of its version (or model) instead,
+    the .part file is then kept in the temp folder rather than next to the images.
+    Image_Download_Complete_Signal: (version_id, url, save_path, sha256 of the content)
     """
-    def __init__(self, version_id: str, version_name: str, url: str, save_path: Path, client: httpx.Client) -> None:
+    Max_Attempts: int = 3
+
+    def __init__(self, version_id: str, version_name: str, url: str, save_path: Path, client: httpx.Client,
+                 request_url: str = '', headers: dict | None = None, expected_hashes: dict | None = None,
+                 archive_writer: ArchiveWriter | None = None, archive_layout: str = 'version') -> None:
+        """
+        :param url: The image URL from the Images API (identifies the image in the signals)
+        :param request_url: The URL actually requested, like a rewritten variant of url (default is url)
+        :param headers: Extra request headers. If it has Accept, the file extension follows the returned Content-Type
+        :param expected_hashes: Hashes to verify against, like the hashes of FileInfoData
+        :param archive_writer: Write the image into an archive instead of save_path
+        :param archive_layout: One archive per 'version' or per 'model'
+        """
         super().__init__()
         self.version_id = version_id
         self.version_name = version_name
         self.image_url = url
+        self.request_url = request_url or url
         self.save_path = save_path
         self.httpx_client = client
+        self.headers = headers or {}
+        self.expected_hashes = expected_hashes or {}
+        self.archive_writer = archive_writer
+        self.archive_layout = archive_layout
+        self.digests: dict[str, str] = {}
         self.signals = CivitaiImageDownloadRunnerSignals()
 
     @Slot()
     def run(self) -> None:
         try:
-            response = self.httpx_client.get(self.image_url, follow_redirects=True)
-            response.raise_for_status()
-
-            if response.status_code == httpx.codes.OK:
-                with self.save_path.open('wb') as f:
-                    for data in response.iter_bytes():
-                        f.write(data)
-                self.signals.Image_Download_Complete_Signal.emit((self.version_id, self.image_url))
-            elif response.status_code == httpx.codes.FOUND:
-                # print('\033[33m' + f'do 304 for {self.image_url}' + '\033[0m')
-                self.image_url = response.headers.get('Location')
-                return self.run()
-            else:
-                raise ValueError(f'Unexpected status code {response.status_code}')
+            for _ in range(self.Max_Attempts):
+                if self.download():
+                    self.signals.Image_Download_Complete_Signal.emit((self.version_id, self.image_url, self.save_path,
+                                                                      self.digests.get('sha256', '')))
+                    return
+            raise ValueError(f'Checksum mismatch after {self.Max_Attempts} attempts')
 
         except httpx.HTTPStatusError as e:
             # print('\033[33m' + f'HTTPStatusError: {self.image_url}. Reason: {str(e)}' + '\033[0m')
@@ -267,3 +332,51 @@ class CivitaiImageDownloadRunner(QRunnable):
         except Exception as e:
             # print('\033[33m' + f'Exception: {self.image_url}. Reason: {str(e)}' + '\033[0m')
             self.signals.Image_Download_Fail_Signal.emit((self.version_id, self.image_url))
+
+    def download(self) -> bool:
+        """
+        Stream the image into a .part file (hashing it on the way), then move it into place
+        :return: False if the digests do not match the expected hashes (nothing is kept)
+        """
+        with self.httpx_client.stream('GET', self.request_url, headers=self.headers,
+                                      follow_redirects=True) as response:
+            response.raise_for_status()
+            if response.status_code != httpx.codes.OK:
+                raise ValueError(f'Unexpected status code {response.status_code}')
+
+            # The server may not serve the format asked for by the Accept header
+            if 'Accept' in self.headers:
+                extension = ImageVariantPolicy.extension_of(response.headers.get('Content-Type', ''))
+                if extension and extension != self.save_path.suffix:
+                    self.save_path = self.save_path.with_suffix(extension)
+            # Write to a .part file first, so an interrupted download never leaves a truncated image behind
+            if self.archive_writer:
+                part_fd, part_name = tempfile.mkstemp(suffix='.part')
+                os.close(part_fd)
+                part_path = Path(part_name)
+            else:
+                part_path = self.save_path.with_name(self.save_path.name + '.part')
+            digests = StreamingDigests()
+            try:
+                with part_path.open('wb') as f:
+                    for data in response.iter_bytes():
+                        f.write(data)
+                        digests.update(data)
+            except BaseException:
+                part_path.unlink(missing_ok=True)
+                raise
+
+        self.digests = digests.hexdigests()
+        if mismatched_hashes(self.digests, self.expected_hashes):
+            part_path.unlink(missing_ok=True)
+            return False
+        if self.archive_writer:
+            try:
+                with part_path.open('rb') as f:
+                    self.archive_writer.add(self.save_path, f, self.digests, self.archive_layout).result()
+            finally:
+                part_path.unlink(missing_ok=True)
+            return True
+        part_path.replace(self.save_path)
+        ChecksumIndex.append(self.save_path, self.digests)
+        return True
@@ -0,0 +1,244 @@
+import os
+import io
+import json
+import hashlib
+import multiprocessing
+from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, Future
+
+from PySide6.QtCore import QObject, Signal, Slot
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, only the resize / re-encode steps need it
+    Image = None
+
+
+@dataclass(slots=True)
+class PostProcessStep:
+    kind: str
+    options: dict = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        """
+        A stable key for the manifest, changing any option makes the step run again
+        :return:
+        """
+        return f'{self.kind}:{json.dumps(self.options, sort_keys=True)}'
+
+
+DEFAULT_POST_PROCESS_STEPS: list[PostProcessStep] = [
+    PostProcessStep('hash', {'algorithm': 'sha256'}),
+    PostProcessStep('resize', {'max_size': 320, 'folder': '.thumbnails'}),
+    PostProcessStep('re-encode', {'format': 'WEBP', 'quality': 85, 'strip_metadata': True, 'folder': '.webp'}),
+]
+
+
+def load_post_process_steps(config_path: Path) -> list[PostProcessStep]:
+    """
+    Load steps from a json file like [{"kind": "resize", "options": {"max_size": 320}}, ...],
+    fall back to DEFAULT_POST_PROCESS_STEPS if the file does not exist or is broken.
+    :param config_path:
+    :return:
+    """
+    try:
+        with config_path.open('r', encoding='utf-8') as f:
+            return [PostProcessStep(kind=step['kind'], options=step.get('options', {})) for step in json.load(f)]
+    except (OSError, ValueError, KeyError, TypeError):
+        return DEFAULT_POST_PROCESS_STEPS[:]
+
+
+def _hash_step(image_path: Path, options: dict) -> str:
+    digest = hashlib.new(options.get('algorithm', 'sha256'))
+    with image_path.open('rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _resize_step(image_path: Path, options: dict) -> str:
+    if Image is None:
+        raise RuntimeError('Pillow is not installed')
+    output_path = image_path.parent / options.get('folder', '.thumbnails') / image_path.name
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    max_size = options.get('max_size', 320)
+    with Image.open(image_path) as image:
+        image.thumbnail((max_size, max_size))
+        image.save(output_path)
+    return str(output_path)
+
+
+def _re_encode_step(image_path: Path, options: dict) -> str:
+    if Image is None:
+        raise RuntimeError('Pillow is not installed')
+    image_format = options.get('format', 'WEBP')
+    output_path = (image_path.parent / options.get('folder', '.webp') / image_path.name).with_suffix(
+        f'.{image_format.lower()}'
+    )
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(image_path) as image:
+        if options.get('strip_metadata', True):
+            # Without info, the encoders have no EXIF / ICC / PNG text chunks (prompts, etc.) to write back
+            image.info = {}
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, quality=options.get('quality', 85))
+    output_path.write_bytes(buffer.getvalue())
+    return str(output_path)
+
+
+POST_PROCESS_STEP_FUNCTIONS = {
+    'hash': _hash_step,
+    'resize': _resize_step,
+    're-encode': _re_encode_step,
+}
+
+
+def run_post_process_steps(image_path: str, steps: list[tuple[str, str, dict]]) -> dict[str, dict]:
+    """
+    Executed in the worker process. Run every (key, kind, options) step on the image and collect the results,
+    a failed step does not stop the remaining steps.
+    :param image_path:
+    :param steps:
+    :return: {step_key: {'ok': bool, 'output': str, 'error': str}}
+    """
+    results = {}
+    for key, kind, options in steps:
+        try:
+            if not (step_function := POST_PROCESS_STEP_FUNCTIONS.get(kind)):
+                raise ValueError(f'Unknown post-process step "{kind}"')
+            results[key] = {'ok': True, 'output': step_function(Path(image_path), options), 'error': ''}
+        except Exception as e:
+            results[key] = {'ok': False, 'output': '', 'error': str(e)}
+    return results
+
+
+class PostProcessManifest:
+    """
+    Results of the post-process steps of one folder, stored in the folder as .postprocess.json
+    {file_name: {'signature': ['sha256', hexdigest] (or [size, mtime_ns]), 'steps': {step_key: result}}}
+    The signature is the content hash given by the downloader, so an image downloaded again with the same bytes
+    (a new mtime) keeps its results. The size and mtime are only used without a hash.
+    """
+    File_Name: str = '.postprocess.json'
+
+    def __init__(self, dir_path: Path) -> None:
+        self.path: Path = dir_path / self.File_Name
+        try:
+            with self.path.open('r', encoding='utf-8') as f:
+                self.records: dict[str, dict] = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    @staticmethod
+    def file_signature(image_path: Path, sha256: str = '') -> list:
+        if sha256:
+            return ['sha256', sha256]
+        stat = image_path.stat()
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def pending_steps(self, image_path: Path, steps: list[PostProcessStep], sha256: str = '') -> list[PostProcessStep]:
+        """
+        Steps that have not succeeded yet for the current content of the file
+        :param image_path:
+        :param steps:
+        :param sha256: The content hash of the file, if known
+        :return:
+        """
+        record = self.records.get(image_path.name)
+        if not record or record['signature'] != self.file_signature(image_path, sha256):
+            return steps[:]
+        return [step for step in steps if not record['steps'].get(step.key, {}).get('ok')]
+
+    def update(self, image_path: Path, results: dict[str, dict], sha256: str = '') -> None:
+        signature = self.file_signature(image_path, sha256)
+        record = self.records.get(image_path.name)
+        if not record or record['signature'] != signature:
+            record = self.records[image_path.name] = {'signature': signature, 'steps': {}}
+        record['steps'].update(results)
+
+    def save(self) -> None:
+        temp_path = self.path.with_suffix('.tmp')
+        with temp_path.open('w', encoding='utf-8') as f:
+            json.dump(self.records, f)
+        os.replace(temp_path, self.path)
+
+
+class PostProcessor(QObject):
+    """
+    Run the post-process steps of the downloaded images in a ProcessPoolExecutor, so neither the GUI nor
+    the download threads have to wait for the GIL. Must be used from the main thread.
+    """
+    PostProcess_Worker_Result_Signal = Signal(tuple)
+    PostProcess_Fail_Signal = Signal(tuple)
+
+    def __init__(self, steps: list[PostProcessStep], max_workers: int | None = None, parent=None) -> None:
+        super().__init__(parent)
+        self.steps: list[PostProcessStep] = steps
+        self.max_workers: int = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.executor: ProcessPoolExecutor | None = None
+        self.manifests: dict[Path, PostProcessManifest] = {}
+        self.pending_count: dict[Path, int] = {}
+        self.PostProcess_Worker_Result_Signal.connect(self.handle_worker_result_signal)
+
+    def submit(self, image_path: Path, sha256: str = '') -> bool:
+        """
+        Submit the image to the process pool, skip it if all steps are already done
+        :param image_path:
+        :param sha256: The content hash computed by the downloader (the size and mtime are used without it)
+        :return: True if submitted
+        """
+        dir_path = image_path.parent
+        manifest = self.manifests.get(dir_path) or PostProcessManifest(dir_path)
+
+        if not (steps := manifest.pending_steps(image_path, self.steps, sha256)):
+            return False
+
+        if self.executor is None:
+            # fork would copy the Qt and thread pool state of this process (with locks held by other threads)
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+
+        future = self.executor.submit(run_post_process_steps, str(image_path),
+                                      [(step.key, step.kind, step.options) for step in steps])
+        # The callback runs in the executor's management thread, go back to the main thread through the signal
+        future.add_done_callback(lambda f: self.PostProcess_Worker_Result_Signal.emit((image_path, sha256, f)))
+        self.manifests[dir_path] = manifest
+        self.pending_count[dir_path] = self.pending_count.get(dir_path, 0) + 1
+        return True
+
+    @Slot(tuple)
+    def handle_worker_result_signal(self, result_info: tuple[Path, str, Future]) -> None:
+        image_path, sha256, future = result_info
+        dir_path = image_path.parent
+        # Results that arrive after shutdown() have nowhere to go
+        if dir_path not in self.pending_count:
+            return
+        self.pending_count[dir_path] -= 1
+
+        if not future.cancelled():
+            try:
+                results = future.result()
+            except Exception as e:
+                results = {step.key: {'ok': False, 'output': '', 'error': str(e)} for step in self.steps}
+
+            if image_path.exists():
+                self.manifests[dir_path].update(image_path, results, sha256)
+
+            if failed := [f'{key} ({result["error"]})' for key, result in results.items() if not result['ok']]:
+                self.PostProcess_Fail_Signal.emit((str(image_path), ', '.join(failed)))
+
+        # Write the manifest once the folder is idle, instead of after every single image
+        if not self.pending_count[dir_path]:
+            del self.pending_count[dir_path]
+            self.manifests.pop(dir_path).save()
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        for manifest in self.manifests.values():
+            manifest.save()
+        self.manifests.clear()
+        self.pending_count.clear()
@@ -0,0 +1,354 @@
+"""
+Headless batch runner for large mirror runs. The URLs are kept in a SQLite work queue, any number of worker
+processes (on this host, or on other hosts that share the queue file) claim URLs with a lease, so workers
+can join or leave in the middle of a run. A URL whose lease expires (the worker crashed) is claimed again.
+
+The queue uses the rollback journal of SQLite by default. Hosts can share it only through a network filesystem
+whose locks work (NFSv4 or SMB with locking enabled), otherwise two workers may claim the same URL or corrupt the
+file. `add --wal` switches the queue to WAL, which is faster with many workers but only works on one host
+(WAL needs shared memory, it breaks on a network filesystem). The mode stays set in the queue file.
+
+    python -m helpmedownload.ShardedRunner add --queue queue.sqlite urls.txt [--wal]
+    python -m helpmedownload.ShardedRunner work --queue queue.sqlite --save-dir DownloadTemp --processes 4
+    python -m helpmedownload.ShardedRunner report --queue queue.sqlite --output report.json
+
+With `work --proxies proxies.txt`, the requests of every worker are spread over the listed egress proxies.
+With `work --archive version` (or model), the images are appended to a tar archive per version (or model).
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from pathlib import Path
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from helpmedownload.ImageVariant import ImageVariantPolicy
+from helpmedownload.ProxyPool import ProxyPool, load_proxy_list
+from helpmedownload.ArchiveOutput import ArchiveWriter, Archive_Layouts
+from helpmedownload.ParserAndDownload import (CivitaiUrlParserRunner, CivitaiImageDownloadRunner, VersionInfoData,
+                                              get_version_save_dir)
+
+
+class SqliteWorkQueue:
+    """
+    Shared work queue. Every method opens its own short transaction, so one instance can be used by several threads.
+    items.state: queued -> leased -> done | failed
+    """
+    Max_Attempts: int = 3
+
+    def __init__(self, db_path: Path, lease_seconds: float = 300.0, wal: bool = False) -> None:
+        """
+        :param db_path:
+        :param lease_seconds:
+        :param wal: Switch the queue file to WAL, only when every worker runs on this host (see the module docstring)
+        """
+        self.db_path: Path = db_path
+        self.lease_seconds: float = lease_seconds
+        with closing(self.connect()) as connection, connection:
+            if wal:
+                connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS items ('
+                               'url TEXT PRIMARY KEY, state TEXT NOT NULL, worker TEXT, '
+                               'lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                               'url TEXT, worker TEXT, version_id TEXT, image_url TEXT, '
+                               'ok INTEGER, path TEXT, finished_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_until)')
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.execute('PRAGMA busy_timeout=30000')
+        return connection
+
+    def add(self, urls: list[str]) -> int:
+        """
+        :param urls:
+        :return: The number of new URLs (the ones already in the queue are ignored)
+        """
+        with closing(self.connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO items (url, state) VALUES (?, 'queued')",
+                                   [(url,) for url in urls])
+            connection.execute('COMMIT')
+            return connection.total_changes - before
+
+    def claim(self, worker: str) -> str | None:
+        """
+        Lease the next queued URL (or a URL whose lease has expired)
+        :param worker:
+        :return: None if there is nothing left to claim
+        """
+        now = time.time()
+        with closing(self.connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                "SELECT url FROM items WHERE state = 'queued' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY rowid LIMIT 1", (now,)
+            ).fetchone()
+            if row:
+                connection.execute("UPDATE items SET state = 'leased', worker = ?, lease_until = ?, "
+                                   "attempts = attempts + 1 WHERE url = ?", (worker, now + self.lease_seconds, row[0]))
+            connection.execute('COMMIT')
+            return row[0] if row else None
+
+    def renew(self, url: str, worker: str) -> None:
+        with closing(self.connect()) as connection:
+            connection.execute("UPDATE items SET lease_until = ? WHERE url = ? AND worker = ? AND state = 'leased'",
+                               (time.time() + self.lease_seconds, url, worker))
+
+    def release(self, url: str, worker: str) -> None:
+        """
+        Give the URL back to the queue (the worker is leaving)
+        :param url:
+        :param worker:
+        :return:
+        """
+        with closing(self.connect()) as connection:
+            connection.execute("UPDATE items SET state = 'queued', worker = NULL, lease_until = NULL, "
+                               "attempts = attempts - 1 WHERE url = ? AND worker = ? AND state = 'leased'",
+                               (url, worker))
+
+    def finish(self, url: str, worker: str, results: list[tuple[str, str, bool, str]], error: str = '') -> None:
+        """
+        Record the image results of the URL and mark it done, or failed after too many attempts
+        :param url:
+        :param worker:
+        :param results: [(version_id, image_url, ok, path), ...]
+        :param error: Set it if the URL could not be parsed
+        :return:
+        """
+        now = time.time()
+        with closing(self.connect()) as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [(url, worker, version_id, image_url, ok, path, now)
+                                    for version_id, image_url, ok, path in results])
+            if not error:
+                connection.execute("UPDATE items SET state = 'done', error = NULL WHERE url = ?", (url,))
+            else:
+                connection.execute("UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                                   "worker = NULL, lease_until = NULL, error = ? WHERE url = ?",
+                                   (self.Max_Attempts, error, url))
+            connection.execute('COMMIT')
+
+    def finished_images(self, url: str) -> set[tuple[str, str]]:
+        """
+        :param url:
+        :return: {(version_id, image_url)} downloaded by the earlier attempts of the URL
+        """
+        with closing(self.connect()) as connection:
+            return set(connection.execute('SELECT version_id, image_url FROM results WHERE url = ? AND ok', (url,)))
+
+    def report(self) -> dict:
+        """
+        Combined report of all workers
+        :return:
+        """
+        with closing(self.connect()) as connection:
+            states = dict(connection.execute('SELECT state, COUNT(*) FROM items GROUP BY state').fetchall())
+            failed_urls = [{'url': url, 'attempts': attempts, 'error': error} for url, attempts, error in
+                           connection.execute("SELECT url, attempts, error FROM items WHERE state = 'failed'")]
+            # An image that failed and was downloaded by a later attempt of the URL is not a failure
+            failed_images = [{'url': url, 'version_id': version_id, 'image_url': image_url} for
+                             url, version_id, image_url in
+                             connection.execute('SELECT DISTINCT url, version_id, image_url FROM results AS r '
+                                                'WHERE NOT ok AND NOT EXISTS (SELECT 1 FROM results WHERE ok AND '
+                                                'url = r.url AND version_id = r.version_id AND '
+                                                'image_url = r.image_url)')]
+            workers = {worker: {'images': images, 'failed_images': failed} for worker, images, failed in
+                       connection.execute('SELECT worker, COUNT(*), SUM(NOT ok) FROM results GROUP BY worker')}
+        return {
+            'urls': {state: states.get(state, 0) for state in ('queued', 'leased', 'done', 'failed')},
+            'images': {'downloaded': sum(w['images'] - w['failed_images'] for w in workers.values()),
+                       'failed': len(failed_images)},
+            'workers': workers,
+            'failed_urls': failed_urls,
+            'failed_images': failed_images,
+        }
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    Renew the lease of the URL while it is being processed
+    """
+    def __init__(self, queue: SqliteWorkQueue, url: str, worker: str) -> None:
+        super().__init__(daemon=True)
+        self.queue, self.url, self.worker = queue, url, worker
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            self.queue.renew(self.url, self.worker)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def parse_url(url: str, client: httpx.Client | ProxyPool) -> tuple[dict[str, VersionInfoData], str]:
+    """
+    Run CivitaiUrlParserRunner in the current thread
+    :param url:
+    :param client:
+    :return: (version_info, error message), the error is set if a version has no image list (like a 429 of the
+        Images API), the URL is tried again then
+    """
+    errors: list[str] = []
+    version_info: dict[str, VersionInfoData] = {}
+    parser = CivitaiUrlParserRunner(url, client)
+    parser.signals.UrlParser_Preliminary_Signal.connect(
+        lambda info: errors.append(info[0]) if info[0] != 'Start' else None
+    )
+    parser.signals.UrlParser_Warning_Signal.connect(lambda info: errors.append(info[0]))
+    parser.signals.UrlParser_Complete_Signal.connect(lambda info: version_info.update(info[1]))
+    parser.run()
+    if not version_info:
+        return version_info, '; '.join(errors)
+    if incomplete_version_ids := [version_id for version_id, data in version_info.items() if not data.is_complete]:
+        return version_info, f'No image list for version(s) {", ".join(incomplete_version_ids)}: {"; ".join(errors)}'
+    return version_info, ''
+
+
+def download_image(version_id: str, version_name: str, url: str, dir_path: Path, client: httpx.Client | ProxyPool,
+                   variant_policy: ImageVariantPolicy, archive_writer: ArchiveWriter | None = None,
+                   archive_layout: str = 'version') -> tuple[str, str, bool, str]:
+    """
+    Run CivitaiImageDownloadRunner in the current thread (the signals are delivered directly)
+    :return: (version_id, image_url, ok, path)
+    """
+    result: list[bool] = []
+    downloader = CivitaiImageDownloadRunner(version_id, version_name, url, dir_path / variant_policy.file_name(url),
+                                            client, request_url=variant_policy.rewrite_url(url),
+                                            headers=variant_policy.request_headers,
+                                            archive_writer=archive_writer, archive_layout=archive_layout)
+    downloader.signals.Image_Download_Complete_Signal.connect(lambda _: result.append(True))
+    downloader.signals.Image_Download_Fail_Signal.connect(lambda _: result.append(False))
+    downloader.run()
+    return version_id, url, bool(result and result[0]), str(downloader.save_path)
+
+
+def run_worker(queue_path: str, save_dir: str, threads: int = 8, worker: str = '',
+               variant_policy: ImageVariantPolicy | None = None, proxies: list[str] | None = None,
+               archive_layout: str = '') -> None:
+    """
+    Claim URLs until the queue is empty. Each URL is parsed, then its images are downloaded by `threads` threads.
+    :param queue_path:
+    :param save_dir:
+    :param threads:
+    :param worker: Name of the worker in the report, default is hostname-pid
+    :param variant_policy: Which image variant to download (default is the URL from the Images API)
+    :param proxies: Egress proxies to spread the requests over (default is the direct connection)
+    :param archive_layout: 'version' / 'model' to write the images into a tar archive per version / model
+    :return:
+    """
+    variant_policy = variant_policy or ImageVariantPolicy()
+    worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+    queue = SqliteWorkQueue(Path(queue_path))
+    url = None
+    archive_writer = ArchiveWriter() if archive_layout else None
+
+    with (ProxyPool(proxies) if proxies else httpx.Client()) as client, \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        try:
+            while url := queue.claim(worker):
+                lease_keeper = LeaseKeeper(queue, url, worker)
+                lease_keeper.start()
+                try:
+                    version_info, error = parse_url(url, client)
+                    # The URL may be tried again after an incomplete parse, only the missing images are downloaded
+                    finished_images = queue.finished_images(url)
+                    tasks = []
+                    for version_id, version_info_data in version_info.items():
+                        if not version_info_data.is_complete:
+                            continue
+                        dir_path = get_version_save_dir(Path(save_dir), version_info_data)
+                        if not archive_writer:
+                            dir_path.mkdir(parents=True, exist_ok=True)
+                        tasks.extend(executor.submit(download_image, version_id, version_info_data.name, image_url,
+                                                     dir_path, client, variant_policy, archive_writer,
+                                                     archive_layout)
+                                     for image_url in version_info_data.image_urls
+                                     if (version_id, image_url) not in finished_images)
+                    queue.finish(url, worker, [task.result() for task in tasks], error=error)
+                    url = None
+                finally:
+                    lease_keeper.stop()
+        except KeyboardInterrupt:
+            # Leaving in the middle of a URL, let another worker take it over
+            if url:
+                queue.release(url, worker)
+        finally:
+            if archive_writer:
+                archive_writer.close()
+            if isinstance(client, ProxyPool):
+                for stats in client.stats():
+                    print(f'{worker} | {stats.proxy}: {stats.requests} requests, {stats.errors} errors'
+                          f'{"" if stats.is_healthy else f", unhealthy ({stats.last_error})"}', flush=True)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description='Sharded batch runner (SQLite work queue)')
+    sub_parsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    add_parser = sub_parsers.add_parser('add', help='Add the URLs of a .txt file (one URL per line) to the queue')
+    add_parser.add_argument('--queue', required=True)
+    add_parser.add_argument('url_file')
+    add_parser.add_argument('--wal', action='store_true',
+                            help='Use WAL for the queue, only if every worker runs on this host')
+
+    work_parser = sub_parsers.add_parser('work', help='Join the run with worker processes')
+    work_parser.add_argument('--queue', required=True)
+    work_parser.add_argument('--save-dir', required=True)
+    work_parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    work_parser.add_argument('--threads', type=int, default=8, help='Download threads of each process')
+    work_parser.add_argument('--variant', default='as_is', help="'as_is', 'original' or a max width like 'width=450'")
+    work_parser.add_argument('--prefer-format', default='', help="Ask for this image format, like 'webp'")
+    work_parser.add_argument('--proxies', default='', help='A .txt file of proxy URLs (one per line)')
+    work_parser.add_argument('--archive', default='', choices=('',) + Archive_Layouts,
+                             help='Write the images into a tar archive per version or per model')
+
+    report_parser = sub_parsers.add_parser('report', help='Write the combined report of all workers')
+    report_parser.add_argument('--queue', required=True)
+    report_parser.add_argument('--output', default='')
+
+    args = arg_parser.parse_args()
+    match args.command:
+        case 'add':
+            with open(args.url_file, 'r', encoding='utf-8') as f:
+                urls = [line.strip() for line in f if line.strip()]
+            print(f'{SqliteWorkQueue(Path(args.queue), wal=args.wal).add(urls)} URL(s) added')
+        case 'work':
+            if args.variant.startswith('width='):
+                variant_policy = ImageVariantPolicy('max_width', int(args.variant[len('width='):]), args.prefer_format)
+            else:
+                variant_policy = ImageVariantPolicy(args.variant, 0, args.prefer_format)
+            proxies = load_proxy_list(Path(args.proxies)) if args.proxies else None
+            processes = [multiprocessing.Process(target=run_worker,
+                                                 args=(args.queue, args.save_dir, args.threads, '', variant_policy,
+                                                       proxies, args.archive))
+                         for _ in range(args.processes)]
+            for process in processes:
+                process.start()
+            try:
+                for process in processes:
+                    process.join()
+            except KeyboardInterrupt:
+                for process in processes:
+                    process.join()
+        case 'report':
+            report = json.dumps(SqliteWorkQueue(Path(args.queue)).report(), indent=2)
+            if args.output:
+                Path(args.output).write_text(report, encoding='utf-8')
+            else:
+                print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import time
+import zlib
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+
+import httpx
+from PySide6.QtCore import Slot
+
+from helpmedownload.ParserAndDownload import CivitaiUrlParserRunner, VersionInfoData
+from helpmedownload.SingleFlight import SingleFlight
+from helpmedownload.JsonDecoding import decode_model_json
+
+
+def image_id_of(image_url: str) -> str:
+    """
+    The file name of a civitai image is its id, like .../width=450/12345.jpeg
+    :param image_url:
+    :return:
+    """
+    return image_url.split('/')[-1].split('.')[0]
+
+
+def model_id_of(url: str) -> str:
+    """
+    :param url: Like https://civitai.com/models/12345/name?modelVersionId=67890
+    :return: '' if it is not a model URL
+    """
+    match = re.search(r'models/(?P<model_id>\d+)', url)
+    return match['model_id'] if match else ''
+
+
+@dataclass(slots=True)
+class WatchedModel:
+    model_id: str
+    url: str
+    interval_minutes: int = 1440
+    version_ids: list[str] = field(default_factory=list)
+    image_ids: dict[str, list[str]] = field(default_factory=dict)
+    next_poll: float = 0.0
+    last_polled: float = 0.0
+    is_baseline: bool = False
+
+
+class WatchList:
+    """
+    Followed models and what has been seen of them, stored as json
+    """
+    Default_Interval_Minutes: int = 1440
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        self.models: dict[str, WatchedModel] = {}
+        # Images handed out by take_delta that are not downloaded yet: {(version_id, image_id): model_id}
+        self.pending: dict[tuple[str, str], str] = {}
+        try:
+            with self.path.open('r', encoding='utf-8') as f:
+                for data in json.load(f):
+                    self.models[data['model_id']] = WatchedModel(**data)
+        except (OSError, ValueError, KeyError, TypeError):
+            self.models = {}
+
+    def save(self) -> None:
+        temp_path = self.path.with_suffix('.tmp')
+        with temp_path.open('w', encoding='utf-8') as f:
+            json.dump([asdict(watched) for watched in self.models.values()], f)
+        os.replace(temp_path, self.path)
+
+    def follow(self, model_id: str, url: str, interval_minutes: int = 0) -> WatchedModel:
+        """
+        Follow the model. The first poll only records what exists (baseline), the later ones fetch the deltas.
+        :param model_id:
+        :param url:
+        :param interval_minutes:
+        :return:
+        """
+        if watched := self.models.get(model_id):
+            return watched
+        watched = WatchedModel(model_id=model_id, url=url,
+                               interval_minutes=interval_minutes or self.Default_Interval_Minutes)
+        self.models[model_id] = watched
+        self.save()
+        return watched
+
+    def unfollow(self, model_id: str) -> bool:
+        if self.models.pop(model_id, None):
+            self.save()
+            return True
+        return False
+
+    @staticmethod
+    def poll_offset(watched: WatchedModel) -> float:
+        """
+        A stable offset inside the interval, so the models followed together are not polled at the same moment
+        :param watched:
+        :return: seconds
+        """
+        return (zlib.crc32(watched.model_id.encode()) % 1000) / 1000 * watched.interval_minutes * 60
+
+    def due_models(self, limit: int, now: float | None = None) -> list[WatchedModel]:
+        """
+        The models whose poll time has come, the most overdue first
+        :param limit: At most this many (the rest are polled on the next tick)
+        :param now:
+        :return:
+        """
+        now = now or time.time()
+        due = sorted((watched for watched in self.models.values() if watched.next_poll <= now),
+                     key=lambda watched: watched.next_poll)
+        return due[:limit]
+
+    def mark_polling(self, watched: WatchedModel, now: float | None = None) -> None:
+        """
+        Schedule the next poll before this one runs, so a slow poll is not started twice.
+        After the baseline, the first poll is moved by poll_offset, which keeps the polls spread out afterwards.
+        :param watched:
+        :param now:
+        :return:
+        """
+        now = now or time.time()
+        watched.last_polled = now
+        if watched.is_baseline:
+            watched.next_poll = now + watched.interval_minutes * 60
+        else:
+            watched.next_poll = now + self.poll_offset(watched)
+
+    def take_delta(self, model_id: str, version_info: dict[str, VersionInfoData]) -> dict[str, VersionInfoData]:
+        """
+        Keep only the versions and images that have not been seen (nor handed out already).
+        The images are marked seen by mark_seen once they are downloaded, release gives back the failed ones.
+        :param model_id:
+        :param version_info: The polled versions
+        :return: The new versions and images (empty for the baseline poll, which marks everything seen)
+        """
+        if not (watched := self.models.get(model_id)):
+            return {}
+
+        is_baseline = not watched.is_baseline
+        watched.is_baseline = True
+        delta: dict[str, VersionInfoData] = {}
+        for version_id, version_info_data in version_info.items():
+            # The images could not be fetched, check the version again next time
+            if not version_info_data.is_complete:
+                continue
+            seen_image_ids = set(watched.image_ids.get(version_id, []))
+            new_image_urls = [url for url in version_info_data.image_urls if image_id_of(url) not in seen_image_ids
+                              and (version_id, image_id_of(url)) not in self.pending]
+            if is_baseline:
+                watched.image_ids.setdefault(version_id, []).extend(image_id_of(url) for url in new_image_urls)
+            elif new_image_urls:
+                self.pending.update(((version_id, image_id_of(url)), model_id) for url in new_image_urls)
+                version_info_data.image_urls = new_image_urls
+                delta[version_id] = version_info_data
+                continue
+            # A version is seen once all its images are, so the poll keeps checking it until then
+            if version_id not in watched.version_ids and not any(key[0] == version_id for key in self.pending):
+                watched.version_ids.append(version_id)
+
+        self.save()
+        return delta
+
+    def mark_seen(self, version_id: str, image_url: str) -> bool:
+        """
+        The image handed out by take_delta is downloaded. Call save() afterwards (like once the version is finished).
+        :param version_id:
+        :param image_url:
+        :return: False if the image was not handed out by take_delta
+        """
+        if not (model_id := self.pending.pop((version_id, image_id_of(image_url)), '')):
+            return False
+        if watched := self.models.get(model_id):
+            watched.image_ids.setdefault(version_id, []).append(image_id_of(image_url))
+            if version_id not in watched.version_ids and not any(key[0] == version_id for key in self.pending):
+                watched.version_ids.append(version_id)
+        return True
+
+    def release(self, version_id: str, image_url: str) -> None:
+        """
+        The image handed out by take_delta failed or was cancelled, the next poll hands it out again
+        :param version_id:
+        :param image_url:
+        :return:
+        """
+        self.pending.pop((version_id, image_id_of(image_url)), None)
+
+
+class CivitaiWatchPollRunner(CivitaiUrlParserRunner):
+    """
+    Poll a followed model: one Models API request, then the Images API only for the new versions and the
+    most recent ones (new images are rarely added to old versions). Emits UrlParser_Complete_Signal like the parser.
+    """
+    Recent_Versions_To_Check: int = 3
+
+    def __init__(self, watched: WatchedModel, httpx_client: httpx.Client,
+                 single_flight: SingleFlight | None = None) -> None:
+        super().__init__(watched.url, httpx_client, single_flight)
+        self.model_id: str = watched.model_id
+        self.seen_version_ids: set[str] = set(watched.version_ids)
+
+    @Slot()
+    def run(self) -> None:
+        try:
+            model_data = self.get_api_json(self.Civitai_Models_API + self.model_id, {},
+                                           'Response code is not OK when trying to get version info',
+                                           decode=decode_model_json)
+        except (httpx.TimeoutException, httpx.RequestError, httpx.ReadTimeout, AssertionError) as e:
+            self.signals.UrlParser_Preliminary_Signal.emit((str(e), self.url))
+            return
+
+        model_name = model_data['name']
+        creator_name = model_data['creator']['username']
+        for index, version_data in enumerate(model_data.get('modelVersions')):
+            version_id = str(version_data['id'])
+            # Versions are listed newest first
+            if version_id in self.seen_version_ids and index >= self.Recent_Versions_To_Check:
+                continue
+            self.construct_version_info_data(version_id, version_data, self.model_id, model_name, creator_name)
+
+        self.signals.UrlParser_Complete_Signal.emit((model_name, self.version_info, self.url))
@@ -7,9 +7,10 @@ from helpmedownload.HelpMeDownloadMainWindow import MainWindow
 
 if __name__ == "__main__":
     app = QApplication([])
-    window = MainWindow()
+    # Set the style before the widgets are created, so they are not polished twice
     if sys.platform == 'darwin' and 'Fusion' in QStyleFactory.keys():
         app.setStyle(QStyleFactory.create('Fusion'))
+    window = MainWindow()
     window.show()
     app.aboutToQuit.connect(window.clear_threadpool)
     app.aboutToQuit.connect(app.quit)
@@ -0,0 +1,179 @@
+"""
+JSON decoding benchmark: parse time and peak memory of the available backends on Models / Images API payloads.
+
+Usage:
+    python tools/json_benchmark.py                                     # synthetic payloads shaped like the API
+    python tools/json_benchmark.py --record 4201 --fixtures fixtures   # save the payloads of a model first
+    python tools/json_benchmark.py --fixtures fixtures
+
+Fixtures are files named model_<id>.json / images_<id>.json (the raw response bodies). Without --fixtures,
+payloads of the size of a popular model are generated.
+"""
+import sys
+import json
+import random
+import string
+import argparse
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from helpmedownload.JsonDecoding import (orjson, msgspec, Backend_Name, decode_model_json, decode_images_json)
+
+
+def random_text(length: int) -> str:
+    return ''.join(random.choices(string.ascii_letters + ' ,.', k=length))
+
+
+def synthetic_model(version_count: int = 40) -> dict:
+    """
+    Shaped like a Models API response of a popular model (descriptions, images and metadata in every version)
+    """
+    return {
+        'id': 4201, 'name': 'Synthetic Model', 'description': random_text(8000), 'type': 'Checkpoint',
+        'creator': {'username': 'creator', 'image': 'https://image.civitai.com/avatar.jpeg'},
+        'tags': [random_text(8) for _ in range(20)],
+        'stats': {'downloadCount': 123456, 'favoriteCount': 2345, 'commentCount': 345, 'rating': 4.9},
+        'modelVersions': [{
+            'id': 100000 + version,
+            'name': f'v{version}',
+            'description': random_text(3000),
+            'trainedWords': [random_text(12) for _ in range(10)],
+            'stats': {'downloadCount': 1234, 'rating': 4.8},
+            'files': [{
+                'id': 200000 + version * 10 + file,
+                'name': f'model_v{version}_{file}.safetensors',
+                'sizeKB': 2082642.5,
+                'type': 'Model',
+                'metadata': {'fp': 'fp16', 'size': 'pruned', 'format': 'SafeTensor'},
+                'pickleScanResult': 'Success', 'virusScanResult': 'Success',
+                'hashes': {'AutoV1': 'A1B2C3D4', 'AutoV2': 'ABCDEF0123', 'SHA256': 'AB' * 32,
+                           'CRC32': '1A2B3C4D', 'BLAKE3': 'CD' * 32},
+                'downloadUrl': f'https://civitai.com/api/download/models/{100000 + version}',
+                'primary': file == 0,
+            } for file in range(3)],
+            'images': [{
+                'url': f'https://image.civitai.com/key/uuid/width=450/{version * 100 + image}.jpeg',
+                'nsfw': 'None', 'width': 512, 'height': 768, 'hash': random_text(28),
+                'meta': {'prompt': random_text(600), 'negativePrompt': random_text(300), 'seed': 12345,
+                         'steps': 30, 'sampler': 'DPM++ 2M Karras', 'cfgScale': 7},
+            } for image in range(10)],
+        } for version in range(version_count)],
+    }
+
+
+def synthetic_images(item_count: int = 100) -> dict:
+    """
+    Shaped like an Images API page (every image has its generation metadata)
+    """
+    return {
+        'items': [{
+            'id': 300000 + item,
+            'url': f'https://image.civitai.com/key/uuid/width=1024/{300000 + item}.jpeg',
+            'hash': random_text(28), 'width': 1024, 'height': 1536, 'nsfwLevel': 'None', 'nsfw': False,
+            'createdAt': '2024-01-01T00:00:00.000Z', 'postId': 400000 + item, 'username': 'creator',
+            'stats': {'cryCount': 1, 'laughCount': 2, 'likeCount': 30, 'dislikeCount': 0, 'heartCount': 40},
+            'meta': {'prompt': random_text(900), 'negativePrompt': random_text(500), 'seed': item, 'steps': 30,
+                     'resources': [{'name': random_text(10), 'type': 'lora', 'weight': 0.8} for _ in range(5)]},
+        } for item in range(item_count)],
+        'metadata': {'nextCursor': 100, 'nextPage': 'https://civitai.com/api/v1/images?cursor=100'},
+    }
+
+
+def record_fixtures(model_id: str, fixtures_dir: Path) -> None:
+    import httpx
+
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+    with httpx.Client(timeout=30) as client:
+        model_response = client.get(f'https://civitai.com/api/v1/models/{model_id}')
+        model_response.raise_for_status()
+        (fixtures_dir / f'model_{model_id}.json').write_bytes(model_response.content)
+        data = json.loads(model_response.content)
+        version_id = data['modelVersions'][0]['id']
+        images_response = client.get('https://civitai.com/api/v1/images',
+                                     params={'modelVersionId': version_id, 'username': data['creator']['username']})
+        images_response.raise_for_status()
+        (fixtures_dir / f'images_{model_id}.json').write_bytes(images_response.content)
+    print(f'Saved the fixtures of model {model_id} in {fixtures_dir}')
+
+
+def load_payloads(fixtures_dir: Path | None) -> list[tuple[str, bytes]]:
+    if fixtures_dir:
+        return [(path.name, path.read_bytes()) for path in sorted(fixtures_dir.glob('*.json'))]
+    random.seed(0)
+    return [('model (synthetic)', json.dumps(synthetic_model()).encode()),
+            ('images (synthetic)', json.dumps(synthetic_images()).encode())]
+
+
+def measure(decode: Callable[[bytes], Any], payload: bytes, repeat: int) -> tuple[float, int]:
+    """
+    :return: (median seconds, peak bytes allocated while decoding)
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        decode(payload)
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = decode(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return statistics.median(durations), peak
+
+
+def used_fields(payload_name: str, data: dict) -> Any:
+    """
+    The fields the parser reads, to check that the extraction keeps them
+    """
+    if payload_name.startswith('model'):
+        return (data['name'], data['creator']['username'],
+                [(version['id'], version['name'],
+                  [(file['id'], file['name'], file['metadata'], file['downloadUrl'], file['sizeKB'],
+                    file['hashes'], file.get('primary', False)) for file in version['files']])
+                 for version in data['modelVersions']])
+    return [item.get('url') for item in data['items']]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Parse time and peak memory of the JSON backends')
+    parser.add_argument('--fixtures', type=Path, help='Folder of model_<id>.json / images_<id>.json')
+    parser.add_argument('--record', metavar='MODEL_ID', help='Save the payloads of the model into --fixtures')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.record, args.fixtures or Path('fixtures'))
+    payloads = load_payloads(args.fixtures or (Path('fixtures') if args.record else None))
+    if not payloads:
+        print('No fixtures found')
+        return 1
+
+    print(f'Backend in use: {Backend_Name}, field extraction: {"msgspec" if msgspec else "not available"}')
+    for payload_name, payload in payloads:
+        decoders: dict[str, Callable[[bytes], Any]] = {'json': json.loads}
+        if orjson:
+            decoders['orjson'] = orjson.loads
+        if msgspec:
+            decoders['msgspec'] = msgspec.json.decode
+            decoders['msgspec (fields)'] = decode_model_json if payload_name.startswith('model') \
+                else decode_images_json
+
+        reference = used_fields(payload_name, json.loads(payload))
+        print(f'\n{payload_name}: {len(payload) / 1024:.0f} KiB')
+        print(f'  {"decoder":<18} {"median ms":>10} {"peak KiB":>10}')
+        for decoder_name, decode in decoders.items():
+            seconds, peak = measure(decode, payload, args.repeat)
+            is_same = used_fields(payload_name, decode(payload)) == reference
+            print(f'  {decoder_name:<18} {seconds * 1000:>10.2f} {peak / 1024:>10.0f}'
+                  f'{"" if is_same else "  (the used fields differ!)"}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""
+Local stand-ins of egress proxies, to try the proxy pool without real proxies.
+
+Usage:
+    python tools/proxy_standins.py --check                            # load balancing and health check test
+    python tools/proxy_standins.py serve --proxies 4 --output proxies.txt
+
+`serve` runs forwarding proxies (plain HTTP and CONNECT tunnels) on localhost until Ctrl+C and writes their list,
+which can be loaded with Option > Proxies > Load Proxy List or `ShardedRunner work --proxies proxies.txt`.
+`--check` starts a local origin, healthy proxies (one of them slow), a proxy answering 502 and a proxy that is
+down, sends requests through ProxyPool, and exits with 1 if the load is not spread or the bad proxies stay healthy.
+"""
+import sys
+import time
+import select
+import socket
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from helpmedownload.ProxyPool import ProxyPool
+
+
+class StandinProxyHandler(BaseHTTPRequestHandler):
+    """
+    Forward absolute-form requests (GET http://host/path) and tunnel CONNECT requests.
+    server.mode: 'ok', 'slow' (server.delay before answering) or 'bad_gateway' (always 502).
+    """
+    server: 'StandinProxyServer'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.count()
+        if self.server.mode == 'bad_gateway':
+            self.send_error(502)
+            return
+        if self.server.mode == 'slow':
+            time.sleep(self.server.delay)
+
+        parts = urlsplit(self.path)
+        headers = {name: value for name, value in self.headers.items()
+                   if name.lower() not in ('proxy-connection', 'proxy-authorization', 'connection')}
+        try:
+            with socket.create_connection((parts.hostname, parts.port or 80), timeout=30) as upstream:
+                request_line = f'GET {parts.path or "/"}{"?" + parts.query if parts.query else ""} HTTP/1.0\r\n'
+                upstream.sendall((request_line + ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+                                  + 'Connection: close\r\n\r\n').encode('latin-1'))
+                # The answer ends when the upstream connection is closed, tell the client not to reuse this one
+                self.close_connection = True
+                head = b''
+                while b'\r\n\r\n' not in head and (data := upstream.recv(65536)):
+                    head += data
+                status_and_headers, separator, body = head.partition(b'\r\n\r\n')
+                self.wfile.write(status_and_headers + b'\r\nConnection: close' + separator + body)
+                while data := upstream.recv(65536):
+                    self.wfile.write(data)
+        except OSError:
+            self.send_error(502)
+
+    def do_CONNECT(self) -> None:
+        self.server.count()
+        if self.server.mode == 'bad_gateway':
+            self.send_error(502)
+            return
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=30)
+        except (OSError, ValueError):
+            self.send_error(502)
+            return
+        self.send_response(200, 'Connection Established')
+        self.end_headers()
+        self.close_connection = True
+        with upstream:
+            sockets = [self.connection, upstream]
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 60)
+                if not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+
+
+class StandinProxyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, mode: str = 'ok', delay: float = 0.0) -> None:
+        super().__init__(('127.0.0.1', 0), StandinProxyHandler)
+        self.mode = mode
+        self.delay = delay
+        self.request_count = 0
+        self.count_lock = threading.Lock()
+
+    def count(self) -> None:
+        with self.count_lock:
+            self.request_count += 1
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self) -> 'StandinProxyServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        body = b'x' * 4096
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def unused_port_url() -> str:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+
+def run_check(requests: int, concurrency: int) -> int:
+    origin = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    origin.daemon_threads = True
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    origin_url = f'http://127.0.0.1:{origin.server_address[1]}/img/'
+
+    healthy = [StandinProxyServer().start(), StandinProxyServer().start(),
+               StandinProxyServer('slow', delay=0.2).start()]
+    bad_gateway = StandinProxyServer('bad_gateway').start()
+    down_url = unused_port_url()
+
+    def fetch(index: int) -> bool:
+        try:
+            if index % 2:
+                return pool.get(f'{origin_url}{index}').is_success
+            with pool.stream('GET', f'{origin_url}{index}') as response:
+                return response.is_success and len(response.read()) == 4096
+        except Exception:
+            return False
+
+    with ProxyPool([server.url for server in healthy] + [bad_gateway.url, down_url], timeout=10) as pool:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(fetch, range(requests)))
+        elapsed = time.perf_counter() - start_time
+        stats = {proxy_stats.proxy: proxy_stats for proxy_stats in pool.stats()}
+
+    print(f'{requests} requests, {concurrency} at a time, {elapsed:.2f}s, {results.count(True)} succeeded')
+    print(f'  {"proxy":<26} {"requests":>8} {"errors":>6} {"avg ms":>7}  state')
+    for proxy_stats in stats.values():
+        print(f'  {proxy_stats.proxy:<26} {proxy_stats.requests:>8} {proxy_stats.errors:>6} '
+              f'{proxy_stats.average_seconds * 1000:>7.0f}  '
+              f'{"healthy" if proxy_stats.is_healthy else "unhealthy"}'
+              f'{f" ({proxy_stats.last_error[:40]})" if proxy_stats.last_error else ""}')
+
+    problems = []
+    for url in (bad_gateway.url, down_url):
+        if stats[url].is_healthy:
+            problems.append(f'{url} is still healthy')
+        if stats[url].requests > ProxyPool.Max_Consecutive_Errors + concurrency:
+            problems.append(f'{url} got {stats[url].requests} requests after it failed')
+    fast, slow = [stats[server.url].requests for server in healthy[:2]], stats[healthy[2].url].requests
+    if min(fast) <= slow:
+        problems.append(f'the slow proxy got as many requests as the fast ones ({slow} vs {fast})')
+    if max(fast) > 2 * min(fast):
+        problems.append(f'the fast proxies are not balanced ({fast})')
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    return 1 if problems else 0
+
+
+def serve(proxy_count: int, output: Path) -> None:
+    servers = [StandinProxyServer().start() for _ in range(proxy_count)]
+    output.write_text('\n'.join(server.url for server in servers) + '\n', encoding='utf-8')
+    print(f'{proxy_count} proxies listed in {output}, Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(5)
+            print(' '.join(f'{server.url}: {server.request_count}' for server in servers), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Local stand-ins of egress proxies')
+    parser.add_argument('command', nargs='?', choices=('serve',), help='Run proxies instead of the check')
+    parser.add_argument('--check', action='store_true', help='Run the load balancing / health check test')
+    parser.add_argument('--proxies', type=int, default=4)
+    parser.add_argument('--output', type=Path, default=Path('proxies.txt'))
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=12)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.proxies, args.output)
+        return 0
+    return run_check(args.requests, args.concurrency)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
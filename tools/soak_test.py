@@ -0,0 +1,317 @@
+"""
+Soak test: run a long batch through the main window (parser and downloader) against a local stand-in of the
+civitai API that injects faults, and check that memory does not grow with the number of completed items.
+
+Usage:
+    python tools/soak_test.py --models 500 --versions 2 --images 10
+    python tools/soak_test.py --fault-rate 0.2 --max-traced-per-item 256 --max-rss-per-item 4096
+
+Every sample_interval the RSS and the traced (tracemalloc) memory are recorded against the number of finished
+jobs (parses and image downloads). The warm-up lasts until the bounded buffers of the window (log lines, progress
+bars of the finished versions) are full, they are made small for the test so that short runs get there too.
+After the warm-up, the growth per item is the least-squares slope of the samples.
+The exit code is 1 if it is above the thresholds, the top allocation sites that grew are printed either way.
+The RSS grows in steps (allocator arenas, Qt caches), so it only fails if it also grew by more than --rss-allowance.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from PySide6.QtCore import QObject, QTimer, Slot
+from PySide6.QtWidgets import QApplication
+
+from helpmedownload.ParserAndDownload import CivitaiUrlParserRunner
+from helpmedownload.HelpMeDownloadMainWindow import MainWindow
+
+
+class FaultInjectingHandler(BaseHTTPRequestHandler):
+    """
+    Model pages (/models/<id>), Models API (/api/v1/models/<id>), Images API (/api/v1/images) and the images
+    (/img/...).
+    A part of the requests (server.fault_rate) is answered with one of the faults.
+    """
+    Faults: tuple[str, ...] = ('slow', 'reset', 'too_many_requests', 'truncated')
+    server: 'FaultInjectingServer'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        parts = urlsplit(self.path)
+        fault = random.choice(self.Faults) if random.random() < self.server.fault_rate else ''
+        self.server.count(fault or 'ok')
+
+        if fault == 'slow':
+            time.sleep(random.uniform(0.05, self.server.max_delay))
+        elif fault == 'reset':
+            # Close with RST instead of FIN
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+            return
+        elif fault == 'too_many_requests':
+            self.send_body(b'{}', 'application/json', status=429, extra_headers={'Retry-After': '1'})
+            return
+
+        if parts.path.startswith('/api/v1/models/'):
+            body, content_type = json.dumps(self.model_data(parts.path.rsplit('/', 1)[-1])).encode(), 'application/json'
+        elif parts.path == '/api/v1/images':
+            version_id = parse_qs(parts.query).get('modelVersionId', ['0'])[0]
+            body, content_type = json.dumps(self.images_data(version_id)).encode(), 'application/json'
+        elif parts.path.startswith('/models/'):
+            body, content_type = b'<html></html>', 'text/html'
+        elif parts.path.startswith('/img/'):
+            body, content_type = os.urandom(self.server.image_size), 'image/jpeg'
+        else:
+            self.send_body(b'{}', 'application/json', status=404)
+            return
+
+        self.send_body(body, content_type, is_truncated=fault == 'truncated')
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200, is_truncated: bool = False,
+                  extra_headers: dict | None = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (extra_headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if is_truncated:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def model_data(self, model_id: str) -> dict:
+        return {
+            'name': f'Soak {model_id}',
+            'creator': {'username': 'soak'},
+            'modelVersions': [{
+                'id': int(model_id) * 100 + index,
+                'name': f'v{index}',
+                'files': [{'id': 1, 'name': 'model.safetensors', 'metadata': {}, 'downloadUrl': '',
+                           'sizeKB': 1.0, 'hashes': {}}],
+            } for index in range(self.server.versions_per_model)],
+        }
+
+    def images_data(self, version_id: str) -> dict:
+        return {'items': [{'id': int(version_id) * 1000 + index,
+                           'url': f'{self.server.base_url}/img/width=450/{version_id}_{index}.jpeg'}
+                          for index in range(self.server.images_per_version)]}
+
+
+class FaultInjectingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fault_rate: float, max_delay: float, versions_per_model: int, images_per_version: int,
+                 image_size: int) -> None:
+        super().__init__(('127.0.0.1', 0), FaultInjectingHandler)
+        self.fault_rate: float = fault_rate
+        self.max_delay: float = max_delay
+        self.versions_per_model: int = versions_per_model
+        self.images_per_version: int = images_per_version
+        self.image_size: int = image_size
+        self.base_url: str = f'http://127.0.0.1:{self.server_address[1]}'
+        self.counts: dict[str, int] = {}
+        self.counts_lock = threading.Lock()
+
+    def count(self, outcome: str) -> None:
+        with self.counts_lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+
+def current_rss() -> int:
+    """
+    :return: The resident set size in bytes, 0 if it cannot be read
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return 0
+    return psutil.Process().memory_info().rss
+
+
+def slope(samples: list[tuple[int, int]]) -> float:
+    """
+    Least-squares slope of y over x
+    :param samples: [(x, y), ...]
+    :return:
+    """
+    if len(samples) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in samples) / len(samples)
+    mean_y = sum(y for _, y in samples) / len(samples)
+    variance = sum((x - mean_x) ** 2 for x, _ in samples)
+    if not variance:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in samples) / variance
+
+
+class SoakMonitor(QObject):
+    """
+    Count the finished jobs and sample the memory, quit when the batch is over (or on timeout)
+    """
+    def __init__(self, app: QApplication, window: MainWindow, warmup_items: int, sample_interval: float,
+                 timeout: float) -> None:
+        """
+        :param app:
+        :param window:
+        :param warmup_items: The least items of the warm-up, it lasts until the buffers are full
+            (then it is the number of items at the end of the warm-up)
+        :param sample_interval:
+        :param timeout:
+        """
+        super().__init__()
+        self.app = app
+        self.window = window
+        self.finished_items: int = 0
+        self.warmup_items: int = warmup_items
+        self.samples: list[tuple[int, int, int]] = []
+        self.warmup_snapshot: tracemalloc.Snapshot | None = None
+        self.deadline: float = time.monotonic() + timeout
+        self.is_timed_out: bool = False
+
+        self.window.scheduler.signals.Job_Finished_Signal.connect(self.handle_job_finished_signal)
+        self.sample_timer = QTimer(self, interval=int(sample_interval * 1000))
+        self.sample_timer.timeout.connect(self.sample)
+        self.sample_timer.start()
+
+    @Slot(int)
+    def handle_job_finished_signal(self, _: int) -> None:
+        self.finished_items += 1
+
+    @Slot()
+    def sample(self) -> None:
+        gc.collect()
+        traced, _ = tracemalloc.get_traced_memory()
+        self.samples.append((self.finished_items, current_rss(), traced))
+        if self.warmup_snapshot is None and self.finished_items >= self.warmup_items and self.are_buffers_full():
+            self.warmup_items = self.finished_items
+            self.warmup_snapshot = tracemalloc.take_snapshot()
+        print(f'items={self.finished_items:>7}  rss={self.samples[-1][1] / 2 ** 20:8.1f} MiB  '
+              f'traced={traced / 2 ** 20:8.1f} MiB  queued={len(self.window.scheduler.queue)}', flush=True)
+
+        is_finished = not self.window.batch_mode and not self.window.thread_count
+        if is_finished or time.monotonic() > self.deadline:
+            self.is_timed_out = not is_finished
+            self.sample_timer.stop()
+            self.app.exit()
+
+
+    def are_buffers_full(self) -> bool:
+        """
+        The log views and the kept progress bars grow until they reach their limit, that is not a leak
+        :return:
+        """
+        logs_full = all(len(log_view.model.records) == log_view.model.records.maxlen
+                        for log_view in (self.window.operation_log, self.window.result_log))
+        return logs_full and len(self.window.finished_version_ids) >= self.window.Max_Finished_Progress_Bars
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Soak and memory-regression test of long batches')
+    parser.add_argument('--models', type=int, default=500)
+    parser.add_argument('--versions', type=int, default=2, help='Versions per model')
+    parser.add_argument('--images', type=int, default=10, help='Images per version')
+    parser.add_argument('--image-size', type=int, default=4096, help='Bytes per image')
+    parser.add_argument('--fault-rate', type=float, default=0.05, help='Share of the requests that get a fault')
+    parser.add_argument('--max-delay', type=float, default=0.5, help='Longest delay of a slow response (seconds)')
+    parser.add_argument('--warmup', type=float, default=0.2,
+                        help='Least share of the items ignored at the start (until the buffers are full)')
+    parser.add_argument('--log-lines', type=int, default=20, help='Lines kept by each log view')
+    parser.add_argument('--progress-bars', type=int, default=5, help='Progress bars kept of the finished versions')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Seconds')
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds')
+    parser.add_argument('--max-traced-per-item', type=float, default=256, help='Bytes of traced growth per item')
+    parser.add_argument('--max-rss-per-item', type=float, default=4096, help='Bytes of RSS growth per item')
+    parser.add_argument('--rss-allowance', type=float, default=4 * 2 ** 20,
+                        help='Bytes of RSS growth after the warm-up that are never a failure')
+    args = parser.parse_args()
+
+    server = FaultInjectingServer(args.fault_rate, args.max_delay, args.versions, args.images, args.image_size)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    CivitaiUrlParserRunner.Civitai_Models_API = f'{server.base_url}/api/v1/models/'
+    CivitaiUrlParserRunner.Civitai_Images_API = f'{server.base_url}/api/v1/images'
+
+    expected_items = args.models * (1 + args.versions * args.images)
+    tracemalloc.start(10)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        app = QApplication(sys.argv)
+        MainWindow.Max_Log_Lines = args.log_lines
+        MainWindow.Max_Finished_Progress_Bars = args.progress_bars
+        window = MainWindow()
+        window.save_dir = Path(temp_dir)
+        window.job_journal_path = Path(temp_dir) / 'batch_journal.jsonl'
+        monitor = SoakMonitor(app, window, warmup_items=int(expected_items * args.warmup),
+                              sample_interval=args.sample_interval, timeout=args.timeout)
+
+        started = time.monotonic()
+        window.handle_loading_batch_urls_signal([f'{server.base_url}/models/{model_id}'
+                                                 for model_id in range(10_000, 10_000 + args.models)])
+        app.exec()
+        elapsed = time.monotonic() - started
+        end_snapshot = tracemalloc.take_snapshot()
+        window.clear_threadpool()
+        window.pool.waitForDone()
+    server.shutdown()
+
+    samples = [sample for sample in monitor.samples if monitor.warmup_snapshot and sample[0] >= monitor.warmup_items]
+    rss_per_item = slope([(items, rss) for items, rss, _ in samples])
+    traced_per_item = slope([(items, traced) for items, _, traced in samples])
+    failed_images = sum(len(urls) for urls in window.download_failed_info.values())
+
+    print(f'\n{monitor.finished_items} items in {elapsed:.1f}s (expected about {expected_items}), '
+          f'{failed_images} failed image(s), {len(window.batch_url)} failed URL(s)')
+    print(f'server: {server.counts}')
+    print(f'kept per version: hyperlinks={len(window.version_hyperlink)} '
+          f'progress bars={len(window.progress_bar_info)} failed info={len(window.download_failed_info)}')
+    print(f'growth after warm-up: rss {rss_per_item:.1f} B/item, traced {traced_per_item:.1f} B/item '
+          f'({len(samples)} samples)')
+
+    if monitor.warmup_snapshot:
+        print('\nTop growth since the warm-up:')
+        for stat in end_snapshot.compare_to(monitor.warmup_snapshot, 'lineno')[:10]:
+            print(f'  {stat}')
+
+    if monitor.is_timed_out:
+        print('\nFAIL: the batch did not finish before the timeout')
+        return 1
+    if len(samples) < 3:
+        print('\nFAIL: not enough samples after the warm-up, use more models, a shorter --sample-interval '
+              'or smaller buffers (--log-lines, --progress-bars)')
+        return 1
+    failures = []
+    if traced_per_item > args.max_traced_per_item:
+        failures.append(f'traced {traced_per_item:.1f} > {args.max_traced_per_item} B/item')
+    rss_growth = rss_per_item * (samples[-1][0] - samples[0][0])
+    if rss_per_item > args.max_rss_per_item and rss_growth > args.rss_allowance:
+        failures.append(f'rss {rss_per_item:.1f} > {args.max_rss_per_item} B/item '
+                        f'({rss_growth / 2 ** 20:.1f} MiB in total)')
+    if failures:
+        print(f'\nFAIL: {", ".join(failures)}')
+        return 1
+    print('\nOK')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Startup benchmark: import time of the main window module and time to the first paint of the window,
+each run in a fresh interpreter (like a real cold start).
+
+Usage:
+    python tools/startup_benchmark.py --runs 10
+    python tools/startup_benchmark.py --max-first-paint 1.5 --importtime
+
+The process time is measured by this script from spawning the interpreter to the first paint, the other
+numbers are measured inside the child process. The exit code is 1 if the median time to the first paint
+(process time) is above --max-first-paint.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+Project_Dir = Path(__file__).parent.parent
+# Modules that should not be loaded before the window is painted
+Deferred_Modules: tuple[str, ...] = ('httpx', 'helpmedownload.ParserAndDownload', 'helpmedownload.BatchUrlsWindow',
+                                     'helpmedownload.PostProcessing')
+
+
+def run_child() -> None:
+    """
+    Start like main.py, print the timings as json at the first paint of the window and quit
+    :return:
+    """
+    start = time.perf_counter()
+    sys.path.insert(0, str(Project_Dir))
+    from PySide6.QtCore import QObject, QEvent
+    from PySide6.QtWidgets import QApplication
+    qt_imported = time.perf_counter()
+    from helpmedownload.HelpMeDownloadMainWindow import MainWindow
+    window_imported = time.perf_counter()
+
+    app = QApplication([])
+    window = MainWindow()
+    constructed = time.perf_counter()
+
+    class FirstPaintFilter(QObject):
+        def eventFilter(self, watched, event) -> bool:
+            if event.type() == QEvent.Paint:
+                painted = time.perf_counter()
+                print(json.dumps({
+                    'import_qt': qt_imported - start,
+                    'import_window': window_imported - qt_imported,
+                    'construct': constructed - window_imported,
+                    'first_paint': painted - start,
+                    'deferred_loaded': [name for name in Deferred_Modules if name in sys.modules],
+                }), flush=True)
+                app.exit()
+            return False
+
+    paint_filter = FirstPaintFilter()
+    window.installEventFilter(paint_filter)
+    window.show()
+    app.exec()
+    window.clear_threadpool()
+
+
+def print_import_time() -> None:
+    """
+    The slowest imports of the main window module (python -X importtime), cumulative microseconds
+    :return:
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import helpmedownload.HelpMeDownloadMainWindow'],
+                            cwd=Project_Dir, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    print('\nSlowest imports (cumulative):')
+    for cumulative, name in sorted(rows, reverse=True)[:15]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Import time and time to the first paint')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-first-paint', type=float, default=0, help='Seconds, 0 to only report')
+    parser.add_argument('--importtime', action='store_true', help='Also list the slowest imports')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+        return 0
+
+    env = {**os.environ, 'QT_QPA_PLATFORM': os.environ.get('QT_QPA_PLATFORM', 'offscreen')}
+    results: list[dict] = []
+    for _ in range(args.runs):
+        spawned = time.perf_counter()
+        child = subprocess.Popen([sys.executable, __file__, '--child'], cwd=Project_Dir, env=env,
+                                 stdout=subprocess.PIPE, text=True)
+        line = child.stdout.readline()
+        process_first_paint = time.perf_counter() - spawned
+        child.wait()
+        if not line:
+            print('The window was not painted')
+            return 1
+        results.append({**json.loads(line), 'process_first_paint': process_first_paint})
+
+    print(f'{args.runs} run(s), median (min - max) seconds:')
+    for key in ('import_qt', 'import_window', 'construct', 'first_paint', 'process_first_paint'):
+        values = [result[key] for result in results]
+        print(f'  {key:<20} {statistics.median(values):.3f} ({min(values):.3f} - {max(values):.3f})')
+    if deferred_loaded := sorted({name for result in results for name in result['deferred_loaded']}):
+        print(f'  loaded before the first paint: {", ".join(deferred_loaded)}')
+
+    if args.importtime:
+        print_import_time()
+
+    median_first_paint = statistics.median(result['process_first_paint'] for result in results)
+    if args.max_first_paint and median_first_paint > args.max_first_paint:
+        print(f'\nFAIL: first paint {median_first_paint:.3f}s > {args.max_first_paint}s')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())